@@ -41,6 +41,11 @@ ItemError
 C1
 >>> print Item.find_by_number("2345").number
 2345
+>>> print Item.find_by_number("c1 ").number   # Case and spacing don't matter
+C1
+>>> print Item.find_by_number("C1").log   # The shared number was noted when the item was saved
+[...] Number 4567 is also used by item(s) #..., so scanning it is ambiguous
+<BLANKLINE>
 
 # Fetch some items and give them names for our tests
 >>> a_5d = Item.find_by_number("2345")
@@ -101,9 +106,27 @@ None
 >>> print Penalty.levy(bob_dobbs)  # No penalty; not late yet
 None
 >>> a_5d.set_due_datetime(a_5d.due - datetime.timedelta(days=10)); a_5d.save()  # Wicked late
+>>> [(student_id == bob_dobbs.id, amount == a_5d.days_overdue() * Penalty.BASE_PENALTY_AMOUNT, item_ids == [a_5d.id])
+...     for student_id, amount, item_ids in Penalty.objects.sweep(commit=False)]   # What the nightly sweep would levy
+[(True, True, True)]
 >>> penalty = Penalty.levy(bob_dobbs)  # We know he's got late equipment, so penalize him
 >>> penalty.amount > 0
 True
+>>> Penalty.objects.sweep()   # Already penalized for these items, so the sweep leaves him alone
+[]
+>>> Penalty.objects.sweep(as_of=datetime.datetime.now() + datetime.timedelta(days=1))   # Nor does tomorrow's
+[]
+>>> [(item.id == a_5d.id, item.days_late == a_5d.days_overdue(), item.checked_out_by.id == bob_dobbs.id)
+...     for item in Item.objects.outstanding(overdue_only=True)]   # The overdue report's rows
+[(True, True, True)]
+>>> spare_lens = Item.objects.create(itemtype=lens, serialnumber="9876")
+>>> spare_lens.check_out(bob_dobbs); spare_lens.set_due_datetime(a_5d.due); spare_lens.save()   # Just as late
+>>> [(student_id == bob_dobbs.id, item_ids == [spare_lens.id])
+...     for student_id, amount, item_ids in Penalty.objects.sweep()]   # Only the item not yet charged is charged
+[(True, True)]
+>>> Penalty.objects.sweep()
+[]
+>>> norace(); spare_lens.check_in(); spare_lens.save()
 >>> norace(); a_5d.check_in(); a_5d.save()
 
 
@@ -118,6 +141,11 @@ Hallmark 5D Kit
 >>> a_kit.contents.add(a_lens)
 >>> print a_kit.contents.all()
 [<Item: Canon 5D Mark II #2345>, <Item: Canon 24-70mm #8765>]
+>>> Item.objects.kit_tree(a_kit.id).kit_contents()   # The kit and its contents in one query
+[<Item: Canon 5D Mark II #2345>, <Item: Canon 24-70mm #8765>]
+>>> [(kit, kit.kit_contents()) for kit in Item.objects.kits()]
+[(<Item: Hallmark 5D Kit #1974>, [<Item: Canon 5D Mark II #2345>, <Item: Canon 24-70mm #8765>])]
+>>> a_kit = Item.find_by_number("1974")
 >>> norace()
 >>> a_kit.check_out(bob_dobbs)
 >>> print a_kit.transaction_set.all()
@@ -160,42 +188,139 @@ None
 True
 >>> a_lens.is_in_stock
 True
+
+# A kit only goes out if everything in it is in stock; otherwise nothing changes
+>>> norace(); a_5d.check_out(bob_dobbs)
+>>> a_kit.check_out(bob_dobbs)
+Traceback (most recent call last):
+...
+TransactionError
+>>> refetch(a_kit).is_in_stock, refetch(a_lens).is_in_stock, a_lens.transaction_set.count()
+(True, True, 2)
+>>> a_5d.check_in()
+>>> ItemType.objects.recount(commit=False)   # The stock counters have kept up
+[]
 """
 
 import datetime
 import time
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.backends.util import typecast_timestamp
 from django.db.models import Q
-from infobase.models import Person, STUDENT_KIND
+from infobase.models import Person, STUDENT_KIND, bump_cache_version
+
+
+class ItemTypeManager(models.Manager):
+    """
+    Upkeep of the per-ItemType stock counters. Item.save() and delete() and 
+    kit check-in/out adjust them in the same transaction as the status change;
+    recount() (utility/reconcile_stock_counts.py) checks them against the items.
+    """
+    def adjust_counts(self, changes):
+        """Apply {(itemtype id, item status): change} to the counters, one UPDATE per item type"""
+        by_type = {}
+        for (itemtype_id, status), change in changes.items():
+            column = Item.STOCK_COUNTS.get(status)
+            if column and change:
+                by_type.setdefault(itemtype_id, []).append((column, change))
+        if not by_type:
+            return
+        cursor = connection.cursor()
+        for itemtype_id, columns in by_type.items():
+            cursor.execute("UPDATE %s SET %s WHERE id = %%s" % (ItemType._meta.db_table, 
+                ", ".join(["%s = %s + %%s" % (column, column) for column, change in columns])),
+                [change for column, change in columns] + [itemtype_id])
+        transaction.commit_unless_managed()
+
+    def recount(self, commit=True):
+        """
+        Count the items of each type and status with one grouped query, and 
+        return a list of (itemtype, counter, stored, actual) for counters that
+        are wrong -- correcting them, unless commit is False.
+        """
+        cursor = connection.cursor()
+        cursor.execute("SELECT itemtype_id, status, COUNT(*) FROM %s GROUP BY itemtype_id, status" 
+            % Item._meta.db_table)
+        actual = {}
+        for itemtype_id, status, count in cursor.fetchall():
+            if status in Item.STOCK_COUNTS:
+                actual[(itemtype_id, Item.STOCK_COUNTS[status])] = count
+        mismatches = []
+        for itemtype in self.all():
+            for column in sorted(Item.STOCK_COUNTS.values()):
+                stored, count = getattr(itemtype, column), actual.get((itemtype.id, column), 0)
+                if stored != count:
+                    mismatches.append((itemtype, column, stored, count))
+        if commit and mismatches:
+            # Only the wrong counters are written, so other columns (and counters
+            # adjusted in the meantime) are left as they are
+            for itemtype, column, stored, count in mismatches:
+                cursor.execute("UPDATE %s SET %s = %%s WHERE id = %%s" % (ItemType._meta.db_table, column), 
+                    [count, itemtype.id])
+                setattr(itemtype, column, count)
+            transaction.commit_unless_managed()
+        return mismatches
 
 
 class ItemType(models.Model):
     """
     A type of equipment that we lend out. This model stores information that
-    applies to all of the items of the type that we have.
+    applies to all of the items of the type that we have, and counts of them
+    by status (see ItemTypeManager).
     """
     manufacturer = models.CharField(max_length=100, blank=True, help_text="Canon, Mamiya, etc. For kits: Hallmark")
     modelname = models.CharField(max_length=100, blank=True, help_text="5D Mark II, 645 AFDII, Light Kit, etc.")
     kit = models.BooleanField(default=False)
     note = models.CharField(blank=True, max_length=250)
+    in_stock_count = models.PositiveIntegerField("in stock", default=0, editable=False)
+    out_count = models.PositiveIntegerField("out", default=0, editable=False)
+    repair_count = models.PositiveIntegerField("in repair", default=0, editable=False)
+
+    objects = ItemTypeManager()
 
     class Admin:
         list_filter = ["kit", "manufacturer"]
-        list_display = ["__unicode__", "kit", "how_many_in_stock", "how_many_out"]
+        list_display = ["__unicode__", "kit", "in_stock_count", "out_count", "repair_count"]
 
     class Meta:
         ordering = ["manufacturer", "modelname"]
         
     def __unicode__(self):
         return u"%s %s" % (self.manufacturer, self.modelname)
-        
+
+    def save(self):
+        """
+        Saving re-reads the stock counters first, since only ItemTypeManager
+        changes them -- so an instance loaded before an item changed status 
+        (e.g. in the admin) doesn't put back stale counts.
+        """
+        if self.id:
+            self.reload_counts()
+        super(ItemType, self).save()
+
+    def reload_counts(self):
+        """Read the stock counters as they are now, in one query"""
+        columns = sorted(Item.STOCK_COUNTS.values())
+        for row in ItemType.objects.filter(id=self.id).values(*columns):
+            for column in columns:
+                setattr(self, column, row[column])
+
     def how_many_in_stock(self):
-        """How many of this item are in stock right now?"""
-        return self.item_set.filter(status=Item.INSTOCK).count()
+        """How many of this item are in stock?"""
+        self.reload_counts()
+        return self.in_stock_count
 
     def how_many_out(self):
-        """How many of this item are checked out right now?"""
-        return self.item_set.filter(status=Item.OUT).count()
+        """How many of this item are checked out?"""
+        self.reload_counts()
+        return self.out_count
+
+    def how_many_in_repair(self):
+        """How many of this item are out for repair?"""
+        self.reload_counts()
+        return self.repair_count
 
 
 class ItemError(Exception):
@@ -205,12 +330,104 @@ class ItemError(Exception):
         return self.message
 
 
+# Whole days from an item's due time to a given time, per database backend, 
+# for ItemManager.outstanding(); others work it out with Item.days_overdue()
+DAYS_LATE_SQL = {
+    'mysql': "TIMESTAMPDIFF(DAY, %(due)s, %(as_of)s)",
+    'sqlite3': "CAST(julianday(%(as_of)s) - julianday(%(due)s) AS INTEGER)",
+    'postgresql': "EXTRACT(DAY FROM %(as_of)s::timestamp - %(due)s)",
+    'postgresql_psycopg2': "EXTRACT(DAY FROM %(as_of)s::timestamp - %(due)s)",
+}
+
+
+REPORT_CHUNK = 200      # items loaded at a time by ItemManager.outstanding()
+
+
+class ItemManager(models.Manager):
+    """
+    Loaders for cage work. Items come with their ItemType (so is_kit and 
+    __unicode__ don't query), and kits with their contents, which 
+    Item.kit_contents() then returns without a query.
+    """
+    def kit_tree(self, item_id):
+        """The item with this id, and its contents if it's a kit, in one query"""
+        rows = list(self.filter(Q(id=item_id) | Q(part_of_kit=item_id)).select_related())
+        try:
+            item = [row for row in rows if row.id == int(item_id)][0]
+        except IndexError:
+            raise self.model.DoesNotExist("No item with id %s" % item_id)
+        item._contents = [row for row in rows if row.part_of_kit_id == item.id]
+        return item
+
+    def outstanding(self, overdue_only=False, students=None, as_of=None, chunk=REPORT_CHUNK):
+        """
+        Checked-out items (kits, but not their contents) by due date, for the 
+        out and overdue reports, with their item types and borrowers loaded and
+        each one's days_late (Item.days_overdue() as of the given datetime, 
+        default now) worked out in the query. If students is True or False, 
+        only items lent to students, or to others.
+
+        One query finds the ids of the items, in report order; the items are
+        then loaded `chunk` at a time, with two queries per chunk, as the 
+        returned iterator is read. (If there are none, it's an empty list.)
+        """
+        if as_of is None:
+            as_of = datetime.datetime.now().replace(microsecond=0)
+        items = self.filter(status=Item.OUT, part_of_kit__isnull=True)
+        if overdue_only:
+            items = items.filter(due__lt=as_of).order_by("due", "checked_out_by")
+        else:
+            items = items.order_by("due")
+        if students is True:
+            items = items.filter(checked_out_by__kind=STUDENT_KIND)
+        elif students is False:
+            items = items.exclude(checked_out_by__kind=STUDENT_KIND)
+        item_ids = [row['id'] for row in items.values("id")]
+        if not item_ids:
+            return []
+        return self._outstanding_chunks(item_ids, as_of, chunk)
+
+    def _outstanding_chunks(self, item_ids, as_of, chunk):
+        days_late = DAYS_LATE_SQL.get(settings.DATABASE_ENGINE)
+        for start in range(0, len(item_ids), chunk):
+            chunk_ids = item_ids[start:start + chunk]
+            items = self.filter(id__in=chunk_ids)
+            if days_late:
+                due = "%s.due" % Item._meta.db_table
+                stamp = as_of.strftime("'%Y-%m-%d %H:%M:%S'")
+                items = items.extra(select={'days_late': "CASE WHEN %s < %s THEN %s + 1 ELSE 0 END" 
+                    % (due, stamp, days_late % {'due': due, 'as_of': stamp})})
+            by_id = dict((item.id, item) for item in items.select_related())
+            borrowers = Person.objects.in_bulk(list(set([item.checked_out_by_id for item in by_id.values()])))
+            for item_id in chunk_ids:
+                if item_id not in by_id:
+                    continue    # deleted since the ids were read
+                item = by_id[item_id]
+                item.checked_out_by = borrowers.get(item.checked_out_by_id)
+                if not days_late:
+                    item.days_late = item.days_overdue(as_of)
+                yield item
+
+    def kits(self):
+        """Every kit, with its contents, in one query"""
+        rows = list(self.filter(Q(itemtype__kit=True) | Q(part_of_kit__isnull=False)).select_related())
+        kits = [row for row in rows if row.itemtype.kit]
+        by_id = dict((kit.id, kit) for kit in kits)
+        for kit in kits:
+            kit._contents = []
+        for row in rows:
+            if row.part_of_kit_id in by_id:
+                by_id[row.part_of_kit_id]._contents.append(row)
+        return kits
+
+
 class Item(models.Model):
     """
     An individual piece of equipment that is lent out.
     """
     INSTOCK, OUT, REPAIR = 1, 2, 3
     STATUS_CHOICES = [(INSTOCK, "in stock"), (OUT, "checked out"), (REPAIR, "out for repair")]
+    STOCK_COUNTS = {INSTOCK: "in_stock_count", OUT: "out_count", REPAIR: "repair_count"}  # ItemType counters
 
     itemtype = models.ForeignKey(ItemType)
     serialnumber = models.CharField(blank=True, max_length=100, help_text="Manufacturer's number")
@@ -224,6 +441,8 @@ class Item(models.Model):
         help_text="Kit that this item belongs to (if any)")
     log = models.TextField(blank=True)
     note = models.CharField(blank=True, max_length=250)
+
+    objects = ItemManager()
     
     class Admin:
         list_display = ["__unicode__", "status", "checked_out_by", "due", "is_kit", "part_of_kit", "serialnumber", "hip_number"]
@@ -240,15 +459,58 @@ class Item(models.Model):
 
     def save(self):
         """
-        Some custom handling of serial numbers and due dates is needed when saving
+        Some custom handling of serial numbers and due dates is needed when saving.
+        If the item's numbers change, ITEM_NUMBER_INDEX is updated, and a number
+        that another item also uses is noted in the log. The item types' stock
+        counters are adjusted in the same transaction.
         """
         if not (self.serialnumber or self.hip_number):
             raise ItemError("Each item needs either a serial number or a HIP number")
-        if self.is_kit:  # A kit's contents should be due when the kit is
-            for item in self.contents.all():
-                item.set_due_datetime(custom_due_datetime=self.due)
-                item.save()
+        numbers = item_numbers(self.hip_number, self.serialnumber)
+        renumbered = self.id is None or ITEM_NUMBER_INDEX.numbers(self.id) != numbers
+        if renumbered:
+            for number in sorted(numbers):
+                others = [i for i in ITEM_NUMBER_INDEX.item_ids(number) if i != self.id]
+                if others:
+                    self.log_this("Number %s is also used by item(s) %s, so scanning it is ambiguous" 
+                        % (number, ", ".join(["#%s" % i for i in others])))
+        previous = self._stored_type_and_status()
         super(Item, self).save()
+        if renumbered:
+            ITEM_NUMBER_INDEX.update(self.id, numbers)
+        changes = {(self.itemtype_id, self.status): 1}
+        if previous:
+            changes[previous] = changes.get(previous, 0) - 1
+        ItemType.objects.adjust_counts(changes)
+        if self.is_kit:  # A kit's contents should be due when the kit is
+            cursor = connection.cursor()
+            cursor.execute("UPDATE %s SET due = %%s WHERE part_of_kit_id = %%s" % Item._meta.db_table, 
+                [self.due, self.id])
+            transaction.commit_unless_managed()
+        self._bump_cache_versions([self.checked_out_by_id])
+    save = transaction.commit_on_success(save)
+
+    def delete(self):
+        previous = self._stored_type_and_status()
+        super(Item, self).delete()
+        if previous:
+            ItemType.objects.adjust_counts({previous: -1})
+        ITEM_NUMBER_INDEX.update(self.id, set())
+        self._bump_cache_versions([self.checked_out_by_id])
+    delete = transaction.commit_on_success(delete)
+
+    def _stored_type_and_status(self):
+        """(itemtype id, status) as saved in the database, or None for a new item"""
+        if self.id is None:
+            return None
+        cursor = connection.cursor()
+        cursor.execute("SELECT itemtype_id, status FROM %s WHERE id = %%s" % Item._meta.db_table, [self.id])
+        return cursor.fetchone()
+
+    def _bump_cache_versions(self, borrower_ids):
+        bump_cache_version("items")
+        for person_id in set(borrower_ids) - set([None]):
+            bump_cache_version("person.%s" % person_id)
 
     def set_due_datetime(self, custom_due_datetime=None):
         """
@@ -278,42 +540,84 @@ class Item(models.Model):
     is_kit.boolean = True
     is_kit = property(is_kit)  # @-style decorator doesn't work with .boolean attr set
 
+    def kit_contents(self):
+        """The items in this kit (none if it isn't one), loaded once with their item types"""
+        if not hasattr(self, "_contents"):
+            self._contents = []
+            if self.is_kit:
+                self._contents = list(self.contents.select_related())
+        return self._contents
+
     def add_to_stock(self, note=None):
         """Add this item to the inventory."""
         if self.status != self.INSTOCK:
             Transaction.objects.create(item=self, kind=Transaction.ADD, note=note)
             self.status = self.INSTOCK
         if self.is_kit:  # For kits, add all items inside
-            for item in self.contents.all():
+            for item in self.kit_contents():
                 item.add_to_stock(note="Added as part of kit %s" % self)
                 item.save()
 
     def check_out(self, person, custom_due_datetime=None, note=None):
-        """Check out this item."""
+        """Check out this item, and everything in it if it's a kit."""
         if self.status != self.INSTOCK:
             raise TransactionError("Item isn't in stock -- %s" % self.get_status_display())
-        Transaction.objects.create(item=self, person=person, kind=Transaction.CHECKOUT, note=note)
-        self.status = self.OUT
-        self.checked_out_by = person
         self.set_due_datetime(custom_due_datetime)
-        self.save()
-        if self.is_kit:  # For kits, check out all items inside
-            for item in self.contents.all():
-                item.check_out(person, note="Checked out as part of kit %s" % self)
+        self._change_hands(Transaction.CHECKOUT, self.OUT, person, note, "Checked out as part of kit %s")
 
     def check_in(self, note=None):
-        """Check this item back in."""
+        """Check this item back in, and everything in it if it's a kit."""
         if self.status != self.OUT:
             raise TransactionError("Item isn't checked out -- %s" % self.status)
-        person = self.checked_out_by
         # Could log late returns by setting note = "LATE" if datetime.datetime.now() > self.due
-        Transaction.objects.create(item=self, person=person, kind=Transaction.CHECKIN, note=note)
-        self.status = self.INSTOCK
-        self.checked_out_by = None
-        self.save()
-        if self.is_kit:  # For kits, check in all items inside
-            for item in self.contents.all():
-                item.check_in(note="Checked in as part of kit %s" % self)
+        self._change_hands(Transaction.CHECKIN, self.INSTOCK, None, note, "Checked in as part of kit %s")
+
+    def _change_hands(self, kind, status, person, note, contents_note):
+        """
+        Record a transaction of the given kind for this item and, if it's a kit,
+        each item in it, and give them all the new status and borrower (and, on 
+        check-out, this item's due date). A kit's contents must all be ready to 
+        go (in stock for check-out, out for check-in) or nothing is changed.
+        It's all one database transaction: a query for the contents (unless 
+        they were loaded with the kit), one insert for all the Transaction rows,
+        one UPDATE for the contents, and one for each item type's stock counters.
+        """
+        contents = self.kit_contents()
+        if contents:
+            ready = (kind == Transaction.CHECKOUT) and self.INSTOCK or self.OUT
+            not_ready = [item for item in contents if item.status != ready]
+            if not_ready:
+                raise TransactionError("Not all of the kit is %s -- %s" % (dict(self.STATUS_CHOICES)[ready],
+                    ", ".join(["%s (%s)" % (item, item.get_status_display()) for item in not_ready])))
+        now = datetime.datetime.now()
+        borrowers = set([self.checked_out_by_id] + [item.checked_out_by_id for item in contents])
+        rows = [(self.id, (person and person.id) or self.checked_out_by_id, now, kind, note)]
+        rows += [(item.id, (person and person.id) or item.checked_out_by_id, now, kind, contents_note % self) 
+            for item in contents]
+        cursor = connection.cursor()
+        if contents:
+            # Only items still as they were loaded are changed; if any aren't, the whole thing is undone
+            ids = [item.id for item in contents]
+            cursor.execute("UPDATE %s SET status = %%s, checked_out_by_id = %%s, due = %%s WHERE status = %%s AND id IN (%s)" 
+                % (Item._meta.db_table, ", ".join(["%s"] * len(ids))), [status, person and person.id, self.due, ready] + ids)
+            if cursor.rowcount != len(ids):
+                raise TransactionError("Kit contents changed meanwhile -- try again")
+            for item in contents:
+                item.status, item.checked_out_by, item.due = status, person, self.due
+        cursor.executemany("INSERT INTO %s (item_id, person_id, timestamp, kind, note) VALUES (%%s, %%s, %%s, %%s, %%s)"
+            % Transaction._meta.db_table, rows)
+        changes = {}
+        for item, previous_status in [(self, self.status)] + [(item, ready) for item in contents]:
+            for key, change in (((item.itemtype_id, previous_status), -1), ((item.itemtype_id, status), 1)):
+                changes[key] = changes.get(key, 0) + change
+        ItemType.objects.adjust_counts(changes)
+        self.status = status
+        self.checked_out_by = person
+        super(Item, self).save()
+        if person:
+            borrowers.add(person.id)
+        self._bump_cache_versions(borrowers)
+    _change_hands = transaction.commit_on_success(_change_hands)
 
     def log_this(self, text):
         """Add a line to the item's log"""
@@ -346,20 +650,109 @@ class Item(models.Model):
     @classmethod
     def find_by_number(cls, number):
         """
-        Find an item by a scanned number, which may be its HIP number or its serial number
+        Find an item by a scanned number, which may be its HIP number or its serial 
+        number (in any case), via ITEM_NUMBER_INDEX. The item comes with its 
+        ItemType and, for a kit, its contents (see ItemManager.kit_tree).
         """
-        matches = cls.objects.filter(Q(hip_number=number)|Q(serialnumber=number))
-        if matches.count() > 1:
-            raise ItemError("Multiple matches for %s: %s" % (number, [item.id for item in matches]))
-        elif matches.count() == 0:
+        item_ids = ITEM_NUMBER_INDEX.item_ids(number)
+        if len(item_ids) > 1:
+            raise ItemError("Multiple matches for %s: %s" % (number, item_ids))
+        try:
+            return cls.objects.kit_tree(item_ids[0])
+        except (IndexError, cls.DoesNotExist):
             raise ItemError("No item found with serial/HIP number %s" % number)
-        else:
-            return matches[0]
 
     def admin_url(self):
         return "/admin/equipment/item/%s/" % self.id
 
 
+def normalize_number(number):
+    """Item numbers are matched without regard to case or surrounding space"""
+    return number.strip().upper()
+
+
+def item_numbers(hip_number, serialnumber):
+    """The set of normalized numbers an item can be found by"""
+    return set([normalize_number(n) for n in (hip_number, serialnumber) if n.strip()])
+
+
+class ItemNumberIndex(object):
+    """
+    Process-local map of normalized HIP and serial numbers to item ids, so that
+    a scan at the cage is one fetch by primary key. Item.save() (when an item's
+    numbers change) and Item.delete() update it in place and bump a version 
+    number in the cache, so other processes reload theirs at their next lookup.
+
+    >>> ITEM_NUMBER_INDEX.item_ids(" c1") == [Item.find_by_number("C1").id]
+    True
+    >>> len(ITEM_NUMBER_INDEX.item_ids("4567"))
+    2
+    >>> ITEM_NUMBER_INDEX.item_ids("no such number")
+    []
+    >>> item = Item.objects.create(itemtype=ItemType.objects.all()[0], serialnumber="Index-1")
+    >>> ITEM_NUMBER_INDEX.item_ids("index-1") == [item.id]
+    True
+    >>> item.serialnumber = "Index-2"; item.save()
+    >>> ITEM_NUMBER_INDEX.item_ids("index-1"), ITEM_NUMBER_INDEX.item_ids("index-2") == [item.id]
+    ([], True)
+    >>> item.delete()
+    >>> ITEM_NUMBER_INDEX.item_ids("index-2")
+    []
+    """
+    VERSION_KEY = "equipment.item_number_index.version"
+
+    def __init__(self):
+        self._items = None      # number: [item ids]
+        self._numbers = None    # item id: set of numbers
+        self._version = None
+
+    def _load(self):
+        """Reload the maps if another process has changed them; return whether it did"""
+        version = cache.get(self.VERSION_KEY)
+        if self._items is not None and version == self._version:
+            return False
+        items, numbers = {}, {}
+        for row in Item.objects.values("id", "hip_number", "serialnumber"):
+            numbers[row['id']] = item_numbers(row['hip_number'], row['serialnumber'])
+            for number in numbers[row['id']]:
+                items.setdefault(number, []).append(row['id'])
+        self._items, self._numbers, self._version = items, numbers, version
+        return True
+
+    def item_ids(self, number):
+        """Ids of the items with this HIP or serial number (more than one if it's ambiguous)"""
+        self._load()
+        return list(self._items.get(normalize_number(number), []))
+
+    def numbers(self, item_id):
+        """The numbers the index has for the item, or None if it has none"""
+        self._load()
+        return self._numbers.get(item_id)
+
+    def update(self, item_id, numbers):
+        """
+        Record the item's numbers (an empty set for a deleted item) in this 
+        process's maps, and tell other processes to reload theirs.
+        """
+        if not self._load():    # A fresh load has read them already
+            for number in self._numbers.pop(item_id, ()):
+                self._items[number].remove(item_id)
+                if not self._items[number]:
+                    del self._items[number]
+            if numbers:
+                self._numbers[item_id] = set(numbers)
+                for number in numbers:
+                    self._items.setdefault(number, []).append(item_id)
+        self._version = time.time()
+        cache.set(self.VERSION_KEY, self._version, 24 * 60 * 60)
+
+    def invalidate(self):
+        self._items = None
+        cache.set(self.VERSION_KEY, time.time(), 24 * 60 * 60)
+
+ITEM_NUMBER_INDEX = ItemNumberIndex()
+
+
 class TransactionError(Exception):
     def __init__(self, message=None):
         self.message = message
@@ -396,6 +789,118 @@ class Transaction(models.Model):
         person = u" by %s " % self.person if self.person else u" "
         return u"%s %s%s(%s)" % (self.item, self.get_kind_display(), person, self.timestamp)
 
+    def save(self):
+        """Check-ins are logged against the borrower, so this also covers items they return"""
+        super(Transaction, self).save()
+        bump_cache_version("items")
+        if self.person_id:
+            bump_cache_version("person.%s" % self.person_id)
+
+
+class PenaltyManager(models.Manager):
+    """
+    Late penalties for many borrowers at once: the nightly sweep 
+    (utility/penalty_sweep.py) and Penalty.levy() both work from overdue_charges().
+    """
+    def overdue_charges(self, as_of=None, person_ids=None):
+        """
+        Return {person id: (days overdue, [ids of the items that late])} for the
+        given people (all students if unspecified) with equipment overdue as of
+        the given datetime (default: now), counting days as Item.days_overdue()
+        does. One query finds every overdue item; the days are worked out from
+        its rows.
+        """
+        if as_of is None:
+            as_of = datetime.datetime.now()
+        query = ("SELECT i.id, i.checked_out_by_id, i.due FROM %s i INNER JOIN %s p ON p.id = i.checked_out_by_id"
+            " WHERE i.status = %%s AND i.due < %%s" % (Item._meta.db_table, Person._meta.db_table))
+        params = [Item.OUT, as_of]
+        if person_ids is None:
+            query += " AND p.kind = %s"
+            params.append(STUDENT_KIND)
+        elif not person_ids:
+            return {}
+        else:
+            query += " AND p.id IN (%s)" % ", ".join(["%s"] * len(person_ids))
+            params.extend(person_ids)
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        charges = {}
+        for item_id, person_id, due in cursor.fetchall():
+            if isinstance(due, basestring):
+                due = typecast_timestamp(due)
+            days = (as_of - due).days + 1
+            most, item_ids = charges.get(person_id, (0, []))
+            if days > most:
+                charges[person_id] = (days, [item_id])
+            elif days == most:
+                item_ids.append(item_id)
+        for days, item_ids in charges.values():
+            item_ids.sort()
+        return charges
+
+    def sweep(self, as_of=None, commit=True):
+        """
+        Levy a penalty on every student with overdue equipment as of the given
+        datetime (default: now), for the most-late items they haven't already
+        been charged for since those items fell due. So a late item is charged 
+        once, for its days late when it was charged, however many nights it 
+        stays out, and an item that comes to be as late as one already charged
+        is charged on its own. Returns a sorted list of (student id, amount,
+        item ids) for the penalties levied -- or, if commit is False, that 
+        would be. They are written in one transaction.
+        """
+        if as_of is None:
+            as_of = datetime.datetime.now()
+        as_of = as_of.replace(microsecond=0)
+        charges = self.overdue_charges(as_of)
+        charged = self.charged_items(charges.keys())
+        levies = []
+        for student_id, (days, item_ids) in charges.items():
+            uncharged = [i for i in item_ids if i not in charged.get(student_id, ())]
+            if uncharged:
+                levies.append((student_id, days * Penalty.BASE_PENALTY_AMOUNT, uncharged))
+        levies.sort()
+        if levies and commit:
+            self._levy_all(levies, as_of)
+        return levies
+
+    def charged_items(self, person_ids):
+        """
+        Return {person id: set of item ids} for the items each of the given 
+        people has been penalized for since the item last fell due, in one query.
+        """
+        if not person_ids:
+            return {}
+        field = Penalty._meta.get_field("items")
+        cursor = connection.cursor()
+        cursor.execute("SELECT p.student_id, m.%s FROM %s p INNER JOIN %s m ON m.%s = p.id"
+            " INNER JOIN %s i ON i.id = m.%s WHERE p.student_id IN (%s) AND p.when_levied >= i.due" 
+            % (field.m2m_reverse_name(), Penalty._meta.db_table, field.m2m_db_table(), 
+            field.m2m_column_name(), Item._meta.db_table, field.m2m_reverse_name(),
+            ", ".join(["%s"] * len(person_ids))), list(person_ids))
+        items = {}
+        for person_id, item_id in cursor.fetchall():
+            items.setdefault(person_id, set()).add(item_id)
+        return items
+
+    def _levy_all(self, levies, when_levied):
+        # One INSERT for the penalties, one SELECT for their ids (the latest
+        # penalty of each student at this time), one INSERT for their items
+        when_levied = Penalty._meta.get_field("when_levied").get_db_prep_save(when_levied)
+        cursor = connection.cursor()
+        cursor.executemany("INSERT INTO %s (student_id, when_levied, amount) VALUES (%%s, %%s, %%s)" 
+            % Penalty._meta.db_table, [(student_id, when_levied, amount) for student_id, amount, item_ids in levies])
+        student_ids = [student_id for student_id, amount, item_ids in levies]
+        cursor.execute("SELECT id, student_id FROM %s WHERE when_levied = %%s AND student_id IN (%s) ORDER BY id" 
+            % (Penalty._meta.db_table, ", ".join(["%s"] * len(student_ids))), [when_levied] + student_ids)
+        penalty_ids = dict((student_id, penalty_id) for penalty_id, student_id in cursor.fetchall())
+        field = Penalty._meta.get_field("items")
+        cursor.executemany("INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (field.m2m_db_table(), 
+            field.m2m_column_name(), field.m2m_reverse_name()), 
+            [(penalty_ids[student_id], item_id) for student_id, amount, item_ids in levies for item_id in item_ids])
+    _levy_all = transaction.commit_on_success(_levy_all)
+
 
 class Penalty(models.Model):
     """
@@ -409,6 +914,8 @@ class Penalty(models.Model):
         help_text="Items that were most late at the time the penalty was levied (for reference).")
     amount = models.IntegerField(default=BASE_PENALTY_AMOUNT, 
         help_text="%s dollar credits per day of lateness" % BASE_PENALTY_AMOUNT)
+
+    objects = PenaltyManager()
     
     class Admin:
         list_display = ["student", "when_levied", "amount"]
@@ -437,17 +944,10 @@ class Penalty(models.Model):
         
         If the method succeeds, it returns the penalty object.
         """
-        equipment_lent = student.item_set.all()
-        overdue_days = 0
-        for item in equipment_lent:
-            overdue_days = max(overdue_days, item.days_overdue())
+        overdue_days, item_ids = cls.objects.overdue_charges(person_ids=[student.id]).get(student.id, (0, []))
         penalty_amount = cls.BASE_PENALTY_AMOUNT * overdue_days
         if penalty_amount == 0:
             return
         penalty = cls.objects.create(student=student, amount=penalty_amount)
-        equipment_lent = student.item_set.all()
-        for item in equipment_lent:
-            if item.days_overdue() == overdue_days:
-                penalty.items.add(item)
-        penalty.save()
+        penalty.items.add(*item_ids)
         return penalty
@@ -0,0 +1,3 @@
+-- For the out and overdue reports (ItemManager.outstanding), which filter and
+-- sort checked-out items by status, due date and kit membership
+CREATE INDEX equipment_item_status_due_kit ON equipment_item (status, due, part_of_kit_id);
@@ -5,7 +5,7 @@ from django.http import HttpResponse, Http404, HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template import loader, Context
 from equipment.models import ItemType, Item, ItemError, Penalty, Transaction, TransactionError
-from infobase.models import Person, STUDENT_KIND, PHASE_END_DATES, phase_for_cohort_and_date
+from infobase.models import Person, STUDENT_KIND, PHASE_CALENDAR, PHASE_END_DATES, cached_fragment, closing_connection, phase_for_cohort_and_date
 
 
 def recent_transactions(person, number=6, hours=1, kind=None):
@@ -161,8 +161,8 @@ def person(request):
         try:
             person = Person.objects.get(id_number=person_id)
             title = unicode(person)
-            checked_out_items = person.item_set.all()
-            transaction_history = person.transaction_set.all()
+            checked_out_items, transaction_history = cached_fragment("equipment.person.%s" % person.id, 
+                ["person.%s" % person.id], lambda: (list(person.item_set.all()), list(person.transaction_set.all())))
         except Person.DoesNotExist:
             error_message = "No person with id number %s" % person_id
     else:
@@ -196,14 +196,15 @@ def report(request, report_kind=None, number=None):
     if report_kind:
         now = datetime.datetime.now()
         title = "%s Report" % report_kind.title()
+        items = None
         try:
             if report_kind == "kits":
-                kits = Item.objects.filter(itemtype__kit=True)
+                kits = Item.objects.kits()
             if report_kind == "item":
                 item = Item.find_by_number(number)
                 title = item
             if report_kind == "instock":
-                itemtypes = [i for i in ItemType.objects.all() if i.how_many_in_stock()]
+                itemtypes = ItemType.objects.filter(in_stock_count__gt=0)
             if report_kind == "latepenalties":
                 try:
                     report_rows = _penalty_report_data(cohort=1, phase=number)
@@ -212,25 +213,48 @@ def report(request, report_kind=None, number=None):
                 except ValueError:
                     report_rows = None
                     error_message = "Can't generate report (incorrect phase?)"
-            if report_kind.startswith("out-"):
-                items = Item.objects.filter(status=Item.OUT, part_of_kit__isnull=True).order_by("due")
-            if report_kind.startswith("overdue-"):
-                items = Item.objects.filter(status=Item.OUT, due__lt=now, part_of_kit__isnull=True).order_by("due","checked_out_by")
-                
-            if report_kind.endswith("-student"):
-                items = items.filter(checked_out_by__kind=STUDENT_KIND)
-            if report_kind.endswith("-staff"):
-                items = items.exclude(checked_out_by__kind=STUDENT_KIND)
+            if report_kind.startswith("out-") or report_kind.startswith("overdue-"):
+                students = None
+                if report_kind.endswith("-student"):
+                    students = True
+                if report_kind.endswith("-staff"):
+                    students = False
+                items = Item.objects.outstanding(overdue_only=report_kind.startswith("overdue-"),
+                    students=students, as_of=now.replace(microsecond=0))
         except ItemError, error_message:
             pass  # Letting error_message get picked up by the template
     else:
         title = "Reports"
     if report_kind and report_kind.endswith("-csv") and report_rows:
         return render_response("csv.html", locals(), mimetype="text/csv", filename=filename)
+    elif report_kind and items:
+        return HttpResponse(closing_connection(_stream_rows("report.html", "report_item.html", locals(), items)))
     else:
         return render_to_response("report.html", locals())
 
 
+ROWS_MARKER = "<!-- rows -->"
+
+def _stream_rows(template, row_template, var_dict, rows):
+    """
+    Yield the page rendered from template in pieces: the part before where it
+    puts {{ rows_marker }}, each of the rows rendered from row_template (as 
+    "item"), then the rest. Long reports start arriving at once and are never
+    held whole in memory.
+    """
+    var_dict = dict(var_dict, rows_marker=ROWS_MARKER)
+    head, tail = loader.get_template(template).render(Context(var_dict)).split(ROWS_MARKER, 1)
+    yield head
+    t = loader.get_template(row_template)
+    c = Context(var_dict)
+    for row in rows:
+        c.push()
+        c["item"] = row
+        yield t.render(c)
+        c.pop()
+    yield tail
+
+
 @user_passes_test(admin_access_allowed)
 def find(request):
     """Control panel for finding items"""
@@ -257,17 +281,18 @@ def buildkit(request, kit_id=None):
     if kit_id:
         try:
             kit = Item.find_by_number(kit_id)
-            assert(kit.itemtype.kit==True)
+            assert(kit.is_kit==True)
             title = "Adding equipment to %s" % kit
-        except (Item.DoesNotExist, AssertionError):
+        except (ItemError, AssertionError):
             raise Http404
     if request.method == "POST":
         number = request.POST['number']
-        item = Item.find_by_number(number)
         try:
-            assert(item.itemtype.kit==False)  # Don't add a kit to a kit
-            assert(item.part_of_kit==None)  # Item must not already be in a kit
+            item = Item.find_by_number(number)
+            assert(item.is_kit==False)  # Don't add a kit to a kit
+            assert(item.part_of_kit_id==None)  # Item must not already be in a kit
             kit.contents.add(item)
+            kit = Item.objects.kit_tree(kit.id)
             message = "Added %s" % item
         except ItemError, error_message:
             pass
@@ -289,9 +314,10 @@ def penalty_statement(request, person_id):
             new_penalty = Penalty.levy(person)
             message = "$%s penalty levied" % new_penalty.amount
         else:
-            current_phase = phase_for_cohort_and_date(person.student_cohort, datetime.date.today())
-            phase_start = PHASE_END_DATES[person.student_cohort][current_phase - 1]
-            penalties = person.penalty_set.filter(when_levied__gte=phase_start)
+            phase_start, phase_end = PHASE_CALENDAR.phase_bounds(person.student_cohort, datetime.date.today())
+            penalties = person.penalty_set.all()
+            if phase_start:  # None during a cohort's first phase on the calendar
+                penalties = penalties.filter(when_levied__gte=phase_start)
             total = sum(p.amount for p in penalties)
             overduesies = Item.objects.filter(status=Item.OUT, due__lt=datetime.datetime.now(), checked_out_by=person).order_by("due")
             # If overdue items have already been charged in a penalty, don't show them
@@ -122,10 +122,19 @@ Finally, restore that deleted scan, since it's used by other doctests below
 
 """
 
+import bisect
+import copy
 import datetime
+import md5
+import operator
 import os
+import time
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.backends.util import typecast_timestamp
+from django.db.models import Q
+from django.utils import simplejson
 
 SECTIONS = "TRIPODS"
 SECTION_CHOICES = zip(SECTIONS, SECTIONS)
@@ -141,6 +150,9 @@ PHASE_END_DATES = { 1: { 1: datetime.date(2009, 11, 6),
                          2: datetime.date(2010, 5, 21),
                          3: datetime.date(2010, 7, 30),
                          4: datetime.date(2010, 10, 22) }}
+# Later academic years go in the PhaseEndDate table; see PhaseCalendar
+
+CACHE_VERSION_TIMEOUT = 30 * 24 * 60 * 60
 
 
 def one_week_ago():
@@ -148,6 +160,277 @@ def one_week_ago():
     return datetime.date.today() - datetime.timedelta(7)
 
 
+def start_of_day(date):
+    """Midnight at the start of date, as a datetime"""
+    return datetime.datetime.combine(date, datetime.time())
+
+
+def closing_connection(chunks):
+    """
+    Pass along the chunks of a streamed response body, closing the database
+    connection when they run out (or the client goes away). Django closes the
+    connection when the view returns, before the body is iterated, so queries 
+    made while streaming open a fresh connection that nothing else would close.
+    """
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        connection.close()
+
+
+def cache_versions(*names):
+    """
+    Current version stamps for the named slices of data, for building cache keys
+    that go stale as soon as the data changes (see bump_cache_version). Model
+    saves and deletes bump these names:
+        people                  any Person
+        person.<id>             one Person, their scans, and equipment they borrow
+        section.<letter>        a Person assigned to the section (in any phase)
+        phases                  the phase calendar
+        scans.<date>            any Scan with a timestamp or class on the date
+        classmeetings.<date>    any ClassMeeting on the date
+        items                   any equipment Item or Transaction
+        courses                 any Course
+        rooms                   any Room
+    """
+    keys = ["infobase.version.%s" % name for name in names]
+    found = cache.get_many(keys)
+    versions = []
+    for key in keys:
+        if key not in found:
+            # Unknown or evicted: start a fresh version so no older entry matches
+            found[key] = time.time()
+            cache.set(key, found[key], CACHE_VERSION_TIMEOUT)
+        versions.append(found[key])
+    return tuple(versions)
+
+
+def bump_cache_version(name):
+    """Invalidate everything cached under the named version"""
+    cache.set("infobase.version.%s" % name, time.time(), CACHE_VERSION_TIMEOUT)
+
+
+def cached_fragment(name, version_names, build, timeout=CACHE_VERSION_TIMEOUT):
+    """
+    Return the value cached under name for the current versions of version_names,
+    calling build() to compute (and cache) it if there isn't one. 
+
+    >>> bump_cache_version("example")   # the cache outlives test runs
+    >>> cached_fragment("example", ["example"], lambda: 1)
+    1
+    >>> cached_fragment("example", ["example"], lambda: 2)
+    1
+    >>> bump_cache_version("example")
+    >>> cached_fragment("example", ["example"], lambda: 2)
+    2
+    """
+    key = _fragment_key(name, cache_versions(*version_names))
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, timeout)
+    return value
+
+
+def cached_fragments(fragments, build, timeout=CACHE_VERSION_TIMEOUT):
+    """
+    cached_fragment() for several names at once. fragments maps each name to 
+    its version names; build(names) is called once, with all the names that
+    weren't cached, and returns a dict of their values. Returns a dict of 
+    values for every name.
+
+    >>> bump_cache_version("example")
+    >>> cached_fragment("example.a", ["example"], lambda: 1)
+    1
+    >>> build = lambda names: dict((name, name.upper()) for name in names)
+    >>> sorted(cached_fragments({"example.a": ["example"], "example.b": ["example"]}, build).items())
+    [('example.a', 1), ('example.b', 'EXAMPLE.B')]
+    """
+    version_names = sorted(set(v for names in fragments.values() for v in names))
+    stamps = dict(zip(version_names, cache_versions(*version_names)))
+    keys = dict((name, _fragment_key(name, [stamps[v] for v in names])) 
+        for name, names in fragments.items())
+    found = cache.get_many(keys.values())
+    values, missing = {}, []
+    for name, key in keys.items():
+        if found.get(key) is None:
+            missing.append(name)
+        else:
+            values[name] = found[key]
+    if missing:
+        built = build(missing)
+        for name in missing:
+            values[name] = built[name]
+            cache.set(keys[name], built[name], timeout)
+    return values
+
+
+def _fragment_key(name, versions):
+    versions = "-".join(["%f" % v for v in versions])
+    return "infobase.fragment.%s.%s" % (name, md5.new(versions).hexdigest())
+
+
+def adjacent_hour_start(time_start, step):
+    """
+    Start time of the hour before (step=-1) or after (step=1) a class starting
+    at `time_start`. Classes skip the noon hour.
+
+    >>> adjacent_hour_start(datetime.time(11, 0), 1)
+    datetime.time(13, 0)
+    >>> adjacent_hour_start(datetime.time(9, 30), -1)
+    datetime.time(8, 30)
+    """
+    hour = time_start.hour + step
+    if hour == 12:
+        hour += step
+    if not 0 <= hour < 24:
+        return None
+    return datetime.time(hour, time_start.minute)
+
+
+class PhaseCalendar(object):
+    """
+    Date-to-phase lookups for each cohort, compiled once from a PHASE_END_DATES-style
+    dict into sorted lists of end dates, so a lookup is a bisect rather than a sort.
+    Results are memoized per (cohort, date), up to MEMO_SIZE entries.
+
+    >>> cal = PhaseCalendar(PHASE_END_DATES)
+    >>> cal.phase(1, datetime.date(2009, 11, 6))
+    1
+    >>> cal.phase(1, datetime.date(2009, 11, 7))
+    2
+    >>> cal.phase(2, datetime.date(2010, 10, 23)) == None
+    True
+    >>> cal.phases_for(1, [datetime.date(2010, 6, 1), datetime.date(2009, 9, 1), datetime.date(2099, 1, 1)])
+    [4, 1, None]
+    >>> cal.phase_bounds(1, datetime.date(2010, 1, 1))
+    (datetime.date(2009, 11, 6), datetime.date(2010, 1, 15))
+    >>> cal.program_end(1, datetime.date(2010, 1, 1))
+    datetime.date(2010, 6, 18)
+    >>> cal.program_end(2, datetime.date(2099, 1, 1))   # Past the calendar: its last program's end
+    datetime.date(2010, 10, 22)
+
+    Phase dates for later academic years are kept in the PhaseEndDate table, and
+    the calendar that phase_for_cohort_and_date() uses picks them up when they are
+    saved (or, in other processes, within RELOAD_INTERVAL seconds):
+    >>> next_year = PhaseEndDate(cohort=1, phase=1, end_date=datetime.date(2010, 11, 5))
+    >>> next_year.save()
+    >>> phase_for_cohort_and_date(1, datetime.date(2010, 9, 1))
+    1
+    >>> next_year.delete()
+    >>> phase_for_cohort_and_date(1, datetime.date(2010, 9, 1)) == None
+    True
+    """
+    MEMO_SIZE = 10000
+    RELOAD_INTERVAL = 300  # seconds
+
+    def __init__(self, phase_end_dates, from_database=False):
+        self.phase_end_dates = phase_end_dates
+        self.from_database = from_database
+        self.reload()
+
+    def reload(self):
+        """
+        (Re)compile the calendar. If this calendar reads from the database,
+        rows are loaded lazily, at the first lookup after this call.
+        """
+        entries = {}
+        for cohort, phases in self.phase_end_dates.items():
+            for phase_num, end_date in phases.items():
+                entries.setdefault(cohort, set()).add((end_date, phase_num))
+        self._static_entries = entries
+        self._compile(entries)
+        self._loaded_at = None
+
+    def _compile(self, entries):
+        self._end_dates = {}
+        self._phases = {}
+        for cohort, pairs in entries.items():
+            pairs = sorted(pairs)
+            self._end_dates[cohort] = [end_date for end_date, phase_num in pairs]
+            self._phases[cohort] = [phase_num for end_date, phase_num in pairs]
+        self._memo = {}
+
+    def _refresh(self):
+        """Merge in PhaseEndDate rows if they haven't been loaded recently"""
+        now = time.time()
+        if self._loaded_at is not None and now - self._loaded_at < self.RELOAD_INTERVAL:
+            return
+        entries = dict((cohort, set(pairs)) for cohort, pairs in self._static_entries.items())
+        for row in PhaseEndDate.objects.all():
+            entries.setdefault(row.cohort, set()).add((row.end_date, row.phase))
+        self._compile(entries)
+        self._loaded_at = now
+
+    def cohorts(self):
+        if self.from_database:
+            self._refresh()
+        return self._end_dates.keys()
+
+    def phase(self, cohort, date):
+        """Phase number for the cohort on the date, or None if it's outside the calendar"""
+        if self.from_database:
+            self._refresh()
+        key = (cohort, date)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        end_dates = self._end_dates[cohort]
+        i = bisect.bisect_left(end_dates, date)
+        result = None
+        if i < len(end_dates):
+            result = self._phases[cohort][i]
+        if len(self._memo) >= self.MEMO_SIZE:
+            self._memo.clear()
+        self._memo[key] = result
+        return result
+
+    def phases_for(self, cohort, dates):
+        """
+        Phase numbers for many dates at once, in the same order as `dates`. 
+        The distinct dates are sorted once and matched in a single pass.
+        """
+        if self.from_database:
+            self._refresh()
+        end_dates = self._end_dates[cohort]
+        phases = self._phases[cohort]
+        resolved = {}
+        i = 0
+        for date in sorted(set(dates)):
+            while i < len(end_dates) and end_dates[i] < date:
+                i += 1
+            resolved[date] = i < len(end_dates) and phases[i] or None
+        return [resolved[date] for date in dates]
+
+    def phase_bounds(self, cohort, date):
+        """
+        (previous phase's end date, this phase's end date) for the phase the cohort
+        is in on the date. Either may be None at the edges of the calendar.
+        """
+        if self.from_database:
+            self._refresh()
+        end_dates = self._end_dates[cohort]
+        i = bisect.bisect_left(end_dates, date)
+        start = i > 0 and end_dates[i - 1] or None
+        end = i < len(end_dates) and end_dates[i] or None
+        return (start, end)
+
+    def program_end(self, cohort, date):
+        """
+        End date of the last phase of the cohort's program running on the date
+        -- the first end, on or after the date, of a phase numbered like the
+        cohort's last -- or of the calendar's last program, if the date is past it.
+        """
+        if self.from_database:
+            self._refresh()
+        last_phase = max(self._phases[cohort])
+        ends = [end_date for end_date, phase_num in zip(self._end_dates[cohort], self._phases[cohort]) 
+            if phase_num == last_phase]
+        return ends[min(bisect.bisect_left(ends, date), len(ends) - 1)]
+
+
 def phase_for_cohort_and_date(cohort, date=None):
     """
     Return an integer representing the phase for the given cohort on the given date.
@@ -159,18 +442,44 @@ def phase_for_cohort_and_date(cohort, date=None):
     >>> phase_for_cohort_and_date(1, datetime.date(2099, 1, 1)) == None
     True
     """
-    result = None
-    phase_dates = sorted(PHASE_END_DATES[cohort].items(), reverse=True)
-    for phase_num, end_date in phase_dates:
-        if date <= end_date:
-            result = phase_num
-    return result
+    return PHASE_CALENDAR.phase(cohort, date)
+
+PHASE_CALENDAR = PhaseCalendar(PHASE_END_DATES, from_database=True)
+
+
+class FlagManager(models.Manager):
+    def usage_counts(self):
+        """Return {flag id: number of people with the flag}, for flags in use, in one grouped query"""
+        field = Person._meta.get_field("flags")
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s, COUNT(*) FROM %s GROUP BY %s" 
+            % (field.m2m_reverse_name(), field.m2m_db_table(), field.m2m_reverse_name()))
+        return dict(cursor.fetchall())
 
 
 class Flag(models.Model):
-    """Special status flags (mostly for student records, e.g. night managers)"""
+    """
+    Special status flags (mostly for student records, e.g. night managers)
+
+    (These depend on data saved from doctests at top of file.)
+    >>> night = Flag.objects.create(label="night manager")
+    >>> Person.objects.get(lastname="Patson").flags.add(night)
+    >>> [pat] = Person.objects.load_flags(Person.objects.filter(lastname="Patson"))
+    >>> pat.flagged("night manager"), pat.flagged("test")
+    (True, False)
+    >>> unloaded = Person.objects.get(lastname="Patson")
+    >>> unloaded.flagged("test")
+    False
+    >>> unloaded.flags.add(Flag.objects.create(label="test"))
+    >>> unloaded.flagged("test")   # Without load_flags(), flags are read afresh
+    True
+    >>> Flag.objects.usage_counts()[night.id]
+    1
+    """
     label = models.CharField(maxlength=30, help_text="A short name for the flag that will appear in the Flag list.")
     description = models.TextField(blank=True, help_text="Internal description to remind you what this flag is for.")
+
+    objects = FlagManager()
     
     class Meta:
         ordering = ["label"]
@@ -199,13 +508,43 @@ class PersonManager(models.Manager):
     [<Person: Pat Patson>]
     >>> Person.objects.section("T", date=DATE1)
     [<Person: Pat Patson>]
+    >>> Person.objects.section("T", date=DATE1).filter(lastname="Patson").count()
+    1
+    >>> Person.objects.section("R", date=DATE1)
+    []
+    >>> Person.objects.section("T", date=DATE5)   # No phase for cohort 1 a year later
+    []
     >>> Person.objects.not_seen_since(DATE1)   # Pat has scanned since end of Phase 1
     []
+    >>> Person.objects.rebuild_last_scan(commit=False)   # last_scan_at kept current by Scan.save()
+    []
+    >>> stale = Person.objects.get(lastname="Patson")
+    >>> stale.last_scan_at = None
+    >>> stale.save()   # Saving a person leaves last_scan_at as the scans set it
+    >>> Person.objects.get(id=stale.id).last_scan_at is None
+    False
+    >>> [date.isoweekday() for date, missing, on_leave in Person.objects.noshows(DATE1)]
+    [5, 4, 3, 2, 1]
     """
     def section(self, letter, date=None, inclusive=False):
-        """Return students in section as of date (today if unspecified)"""
-        section_people = sorted(s for s in self.enrolled(date=date, inclusive=inclusive) if s.section(date) == letter)
-        return section_people
+        """
+        Return students in section as of date (today if unspecified), ordered by name.
+        The phase is worked out once per cohort and the matching student_sec_phaseN
+        column is filtered in the database, so the result is a lazy queryset.
+        """
+        if date == None:
+            date = datetime.date.today()
+        cohort_filters = []
+        for cohort in PHASE_CALENDAR.cohorts():
+            phase = phase_for_cohort_and_date(cohort, date)
+            if phase:
+                cohort_filters.append(Q(student_cohort=cohort, **{"student_sec_phase%d" % phase: letter}))
+            elif not letter:  # Person.section() is "" when there's no current phase
+                cohort_filters.append(Q(student_cohort=cohort))
+        if not cohort_filters:
+            return self.none()
+        section_people = self.enrolled(date=date, inclusive=inclusive).filter(reduce(operator.or_, cohort_filters))
+        return section_people.order_by("lastname", "preferred_firstname", "firstname")
 
     def instructors(self, letters):
         """Return Person objects matching instructor letters -- used by CSV schedule import"""
@@ -224,10 +563,144 @@ class PersonManager(models.Manager):
             return self.filter(kind=STUDENT_KIND, id_expiry__gt=date)            
 
     def not_seen_since(self, date):
-        """Return all the people who have not scanned since the given date"""
-        seen = self.filter(scan__timestamp__gte=date).distinct().values('id')
-        not_seen = self.enrolled(date).exclude(id__in=[v['id'] for v in seen])
-        return not_seen
+        """
+        Return the students enrolled on the given date who have not scanned since
+        then. This is a range filter on Person.last_scan_at, which Scan.save() and
+        Scan.delete() keep current.
+        """
+        return self.enrolled(date).filter(
+            Q(last_scan_at__isnull=True) | Q(last_scan_at__lt=start_of_day(date)))
+
+    def record_scans(self, times):
+        """Move last_scan_at forward (never backward) to the times in {person_id: time}"""
+        if not times:
+            return
+        cursor = connection.cursor()
+        cursor.executemany("UPDATE %s SET last_scan_at = %%s WHERE id = %%s AND (last_scan_at IS NULL OR last_scan_at < %%s)"
+            % Person._meta.db_table, [(when, person_id, when) for person_id, when in times.items()])
+        transaction.commit_unless_managed()
+
+    def last_scan_times(self, person_ids=None, before=None):
+        """
+        Return {person_id: time of latest scan} computed from the Scan table, 
+        for the given people (everyone with scans if unspecified), counting only
+        scans made before the given datetime if there is one. A scan that 
+        absorbed repeats counts as of its last_seen time.
+        """
+        conditions, params = [], []
+        if person_ids is not None:
+            if not person_ids:
+                return {}
+            conditions.append("person_id IN (%s)" % ", ".join(["%s"] * len(person_ids)))
+            params.extend(person_ids)
+        if before is not None:
+            conditions.append("timestamp < %s")
+            params.append(before)
+        query = "SELECT person_id, MAX(timestamp), MAX(last_seen) FROM %s" % Scan._meta.db_table
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        cursor = connection.cursor()
+        cursor.execute(query + " GROUP BY person_id", params)
+        times = {}
+        for person_id, latest, last_seen in cursor.fetchall():
+            # Some backends hand back aggregated datetimes as strings
+            latest, last_seen = [isinstance(t, basestring) and typecast_timestamp(t) or t 
+                for t in (latest, last_seen)]
+            times[person_id] = max(latest, last_seen or latest)
+        return times
+
+    def noshows(self, end_date=None, days=7):
+        """
+        The no-show report for the week ending on end_date (today if unspecified):
+        a list of (date, missing, on_leave) for each weekday, newest first, where 
+        missing and on_leave list the students enrolled on that date who have not
+        scanned from then through end_date, ordered by section. Each student's
+        last scan time and section are looked up once for the whole week.
+        """
+        today = datetime.date.today()
+        if end_date is None:
+            end_date = today
+        dates = [end_date - datetime.timedelta(days=n) for n in range(days)]
+        dates = [d for d in dates if d.isoweekday() < 6]   # don't show weekends
+        if not dates:
+            return []
+        # Anyone missing on some day is enrolled on the earliest one
+        students = self.enrolled(dates[-1])
+        if end_date >= today:
+            students = list(students.filter(
+                Q(last_scan_at__isnull=True) | Q(last_scan_at__lt=start_of_day(dates[0]))))
+            last_scans = dict((p.id, p.last_scan_at) for p in students)
+        else:
+            students = list(students)
+            last_scans = self.last_scan_times([p.id for p in students], 
+                before=start_of_day(end_date + datetime.timedelta(days=1)))
+        missing = dict((d, ([], [])) for d in dates)
+        for person in students:
+            last_scan = last_scans.get(person.id)
+            section_key = person.section_ord(end_date)
+            for date in dates:
+                if last_scan and last_scan >= start_of_day(date):
+                    break   # seen since this date, so since every earlier one too
+                if person.is_enrolled(date):
+                    missing[date][person.is_on_leave(date)].append((section_key, person))
+        noshows = []
+        for date in dates:
+            mia_people, loa_people = [[person for key, person in sorted(people, key=operator.itemgetter(0))] 
+                for people in missing[date]]
+            noshows.append((date, mia_people, loa_people))
+        return noshows
+
+    def load_flags(self, people):
+        """
+        Look up the flags of all the given people in one query, so that their 
+        flag_labels() and flagged() need no queries of their own. Returns people.
+        """
+        people = list(people)
+        labels = self.flag_labels_for([p.id for p in people if p.id])
+        for person in people:
+            person._flag_labels = labels.get(person.id, frozenset())
+        return people
+
+    def flag_labels_for(self, person_ids):
+        """Return {person id: frozenset of flag labels} for those of the people with flags, in one query"""
+        if not person_ids:
+            return {}
+        field = Person._meta.get_field("flags")
+        cursor = connection.cursor()
+        cursor.execute("SELECT j.%s, f.label FROM %s j INNER JOIN %s f ON f.id = j.%s WHERE j.%s IN (%s)" 
+            % (field.m2m_column_name(), field.m2m_db_table(), Flag._meta.db_table, 
+            field.m2m_reverse_name(), field.m2m_column_name(), ", ".join(["%s"] * len(person_ids))), person_ids)
+        labels = {}
+        for person_id, label in cursor.fetchall():
+            labels.setdefault(person_id, set()).add(label)
+        return dict((person_id, frozenset(found)) for person_id, found in labels.items())
+
+    def refresh_last_scan(self, person_ids):
+        """Recompute last_scan_at for the given people from their scans"""
+        times = self.last_scan_times(person_ids)
+        cursor = connection.cursor()
+        cursor.executemany("UPDATE %s SET last_scan_at = %%s WHERE id = %%s" % Person._meta.db_table,
+            [(times.get(person_id), person_id) for person_id in set(person_ids)])
+        transaction.commit_unless_managed()
+
+    def rebuild_last_scan(self, commit=True):
+        """
+        Recompute everyone's last_scan_at from the Scan table. Return a list of
+        (person_id, stored, recomputed) for every person whose stored value was
+        wrong; with commit=False that is all that happens.
+        """
+        times = self.last_scan_times()
+        mismatches = []
+        for row in self.values("id", "last_scan_at"):
+            person_id, stored = row["id"], row["last_scan_at"]
+            if stored != times.get(person_id):
+                mismatches.append((person_id, stored, times.get(person_id)))
+        if commit and mismatches:
+            cursor = connection.cursor()
+            cursor.executemany("UPDATE %s SET last_scan_at = %%s WHERE id = %%s" % Person._meta.db_table,
+                [(recomputed, person_id) for person_id, stored, recomputed in mismatches])
+            transaction.commit_unless_managed()
+        return mismatches
 
 
 class Person(models.Model):
@@ -294,6 +767,10 @@ class Person(models.Model):
     staff_work_extension = models.CharField(max_length=4, blank=True)
     staff_instant_messaging = models.CharField(max_length=50, blank=True)
     instructor_letter = models.CharField(blank=True, max_length=1)
+    last_scan_at = models.DateTimeField(blank=True, null=True, editable=False, db_index=True,
+        help_text="Time of the person's latest scan; maintained by Scan.save() and Scan.delete()")
+    modified_at = models.DateTimeField(auto_now=True, null=True, db_index=True,
+        help_text="Time the record was last saved; used by the students API for incremental syncs")
 
     objects = PersonManager()   # the default manager; used by admin
 
@@ -325,8 +802,39 @@ class Person(models.Model):
         if not self.preferred_firstname:
             self.preferred_firstname = self.firstname
         if self.kind == STUDENT_KIND and not self.id_expiry:
-            self.id_expiry = PHASE_END_DATES[self.student_cohort][4] + datetime.timedelta(days=7)
+            program_end = PHASE_CALENDAR.program_end(self.student_cohort, datetime.date.today())
+            self.id_expiry = program_end + datetime.timedelta(days=7)
+        sections = self.all_sections()
+        if self.id:
+            try:
+                stored = Person.objects.get(id=self.id)
+                sections |= stored.all_sections()
+                # last_scan_at belongs to Scan.save() and delete(); don't write back 
+                # whatever this (possibly long-lived) instance was loaded with
+                self.last_scan_at = stored.last_scan_at
+            except Person.DoesNotExist:
+                pass
         super(Person, self).save() 
+        if hasattr(self, "_flag_labels"):
+            del self._flag_labels
+        ID_NUMBER_INDEX.invalidate()
+        self._bump_cache_versions(self.id, sections)
+
+    def delete(self):
+        person_id, sections = self.id, self.all_sections()
+        super(Person, self).delete()
+        ID_NUMBER_INDEX.invalidate()
+        self._bump_cache_versions(person_id, sections)
+
+    def all_sections(self):
+        """Set of the section letters this person is assigned to, in any phase"""
+        return set([getattr(self, "student_sec_phase%d" % n) for n in range(1, 5)]) - set([""])
+
+    def _bump_cache_versions(self, person_id, sections):
+        bump_cache_version("people")
+        bump_cache_version("person.%s" % person_id)
+        for section in sections:
+            bump_cache_version("section.%s" % section)
 
     def is_active(self):
         if self.id_expiry:
@@ -365,8 +873,9 @@ class Person(models.Model):
         if not date:
             date = datetime.date.today()
         section = ""
-        if phase_for_cohort_and_date(self.student_cohort, date):
-            section = getattr(self, "student_sec_phase%d" % phase_for_cohort_and_date(self.student_cohort, date))
+        phase = phase_for_cohort_and_date(self.student_cohort, date)
+        if phase:
+            section = getattr(self, "student_sec_phase%d" % phase)
         return section
 
     def section_ord(self, date=None):
@@ -384,12 +893,11 @@ class Person(models.Model):
 
     def id_photo_url(self):
         """Relative URL to ID photo JPEG"""
-        src = "faces/%s.jpg" % self.id_number
-        path = os.path.join(settings.MEDIA_ROOT, src)
-        if os.path.exists(path):
-            return os.path.join(settings.MEDIA_URL, src)
-        else:
-            return os.path.join(settings.MEDIA_URL, "faces/no_photo.jpg")
+        return PHOTO_MANIFEST.photo_url(self.id_number)
+
+    def id_thumbnail_url(self):
+        """Relative URL to a small version of the ID photo, for pages showing many people"""
+        return PHOTO_MANIFEST.thumbnail_url(self.id_number)
         
     def happy_birthday(self):
         """Is it this person's birthday?"""
@@ -397,15 +905,166 @@ class Person(models.Model):
         bd = self.date_of_birth
         return (today.month, today.day) == (bd.month, bd.day)
         
+    def flag_labels(self):
+        """
+        Frozenset of the labels of this person's flags. Looked up on each call,
+        unless Person.objects.load_flags() has loaded them for a whole page of 
+        people; saving the person (or load_flags() again) refreshes those.
+        """
+        if hasattr(self, "_flag_labels"):
+            return self._flag_labels
+        return Person.objects.flag_labels_for([self.id]).get(self.id, frozenset())
+
     def flagged(self, flag_label):
         """Is this person flagged with the named flag?"""
-        return bool(self.flags.filter(label=flag_label).count())
+        return flag_label in self.flag_labels()
 
     def whereis_url(self):
         """URL for 'whereis' screen for this person"""
         return "/report/whereis/%s/" % self.id_number
 
 
+class IdNumberIndex(object):
+    """
+    Process-local map of ID numbers to Person objects, so the scan kiosk doesn't
+    query for the person on every scan. Person.save() and delete() clear it here
+    and bump a version number in the cache, so other processes reload theirs at
+    their next lookup.
+
+    >>> ID_NUMBER_INDEX.get("1000666")
+    <Person: Guest Instructor>
+    >>> ID_NUMBER_INDEX.get("9999999")
+    Traceback (most recent call last):
+    ...
+    DoesNotExist: No person with ID number 9999999
+    """
+    VERSION_KEY = "infobase.id_number_index.version"
+
+    def __init__(self):
+        self._people = None
+        self._version = None
+
+    def get(self, id_number):
+        """Return the Person with this ID number, or raise Person.DoesNotExist"""
+        version = cache.get(self.VERSION_KEY)
+        if self._people is None or version != self._version:
+            self._people = dict((p.id_number, p) for p in Person.objects.exclude(id_number=""))
+            self._version = version
+        try:
+            return self._people[id_number]
+        except KeyError:
+            raise Person.DoesNotExist("No person with ID number %s" % id_number)
+
+    def invalidate(self):
+        self._people = None
+        cache.set(self.VERSION_KEY, time.time(), 24 * 60 * 60)
+
+ID_NUMBER_INDEX = IdNumberIndex()
+
+
+class PhotoManifest(object):
+    """
+    Which ID photos exist, so pages don't check the disk for each person. Photos
+    are MEDIA_ROOT/faces/<id number>.jpg; utility/make_thumbnails.py writes small
+    copies under content-hashed names (safe to cache forever) and a manifest of
+    them, faces/thumbs/manifest.json. The manifest, or a listing of the faces 
+    directory if there isn't one yet, is reread when it or the directory changes,
+    checked at most every RELOAD_INTERVAL seconds.
+
+    >>> PHOTO_MANIFEST.photo_url("no such number")
+    '/static/faces/no_photo.jpg'
+    """
+    RELOAD_INTERVAL = 60
+    FACES = "faces"
+    THUMBS = "faces/thumbs"
+    MANIFEST = "faces/thumbs/manifest.json"
+    NO_PHOTO = "faces/no_photo.jpg"
+
+    def __init__(self):
+        self._photos = {}       # id number: (photo path, thumbnail path or None)
+        self._stamp = None
+        self._checked = 0
+
+    def _refresh(self):
+        if self._checked + self.RELOAD_INTERVAL > time.time():
+            return
+        self._checked = time.time()
+        stamp = []
+        for src in (self.FACES, self.MANIFEST):
+            try:
+                stamp.append(os.stat(os.path.join(settings.MEDIA_ROOT, src)).st_mtime)
+            except OSError:
+                stamp.append(None)
+        if stamp != self._stamp:
+            self._photos = self.load()
+            self._stamp = stamp
+
+    def load(self):
+        """
+        Return {id number: (photo path, thumbnail path)}, with paths relative to
+        MEDIA_ROOT, from the manifest plus any photos it doesn't cover yet
+        (which have no thumbnail).
+        """
+        photos = {}
+        try:
+            manifest = simplejson.load(open(os.path.join(settings.MEDIA_ROOT, self.MANIFEST)))
+        except (IOError, ValueError):
+            manifest = {}
+        try:
+            names = os.listdir(os.path.join(settings.MEDIA_ROOT, self.FACES))
+        except OSError:
+            names = []
+        for name in names:
+            id_number, ext = os.path.splitext(name)
+            if ext == ".jpg" and name != os.path.basename(self.NO_PHOTO):
+                thumbnail = manifest.get(id_number, {}).get("thumbnail")
+                photos[id_number] = ("%s/%s" % (self.FACES, name), thumbnail)
+        return photos
+
+    def photo_url(self, id_number):
+        self._refresh()
+        photo = self._photos.get(id_number, (self.NO_PHOTO, None))[0]
+        return settings.MEDIA_URL + photo
+
+    def thumbnail_url(self, id_number):
+        self._refresh()
+        photo, thumbnail = self._photos.get(id_number, (self.NO_PHOTO, None))
+        return settings.MEDIA_URL + (thumbnail or photo)
+
+PHOTO_MANIFEST = PhotoManifest()
+
+
+class PhaseEndDate(models.Model):
+    """
+    The end date of one phase for one cohort, for academic years not covered by
+    PHASE_END_DATES. Saving or deleting one updates the phase calendar in place.
+    """
+    cohort = models.SmallIntegerField(choices=Person.COHORT_CHOICES)
+    phase = models.SmallIntegerField(choices=[(n, "Phase %d" % n) for n in range(1, 5)])
+    end_date = models.DateField()
+
+    class Admin:
+        list_display = ["end_date", "cohort", "phase"]
+        list_filter = ["cohort"]
+
+    class Meta:
+        ordering = ["cohort", "end_date"]
+        unique_together = [("cohort", "end_date")]
+
+    def __unicode__(self):
+        return u"%s Phase %s ends %s" % (self.get_cohort_display(), self.phase, self.end_date)
+
+    def save(self):
+        super(PhaseEndDate, self).save()
+        PHASE_CALENDAR.reload()
+        bump_cache_version("phases")
+
+    def delete(self):
+        super(PhaseEndDate, self).delete()
+        PHASE_CALENDAR.reload()
+        bump_cache_version("phases")
+
+
 class Vehicle(models.Model):
     """Vehicles (for students today, but someday we may require staff permits too)"""
     owner = models.ForeignKey(Person)
@@ -454,6 +1113,14 @@ class Course(models.Model):
 
     def __unicode__(self):
         return u"%s: %s" % (self.course_number, self.schedule_name)
+
+    def save(self):
+        super(Course, self).save()
+        bump_cache_version("courses")
+
+    def delete(self):
+        super(Course, self).delete()
+        bump_cache_version("courses")
         
 
 class Room(models.Model):
@@ -489,6 +1156,188 @@ class Room(models.Model):
         if self.abbreviation and not self.full_name:
             self.full_name = self.abbreviation
         super(Room, self).save()
+        bump_cache_version("rooms")
+
+    def delete(self):
+        super(Room, self).delete()
+        bump_cache_version("rooms")
+
+
+class ClassMeetingManager(models.Manager):
+    """
+    Custom manager methods for the ClassMeeting class.
+
+    Bulk attendance gives the same answers as ClassMeeting.attendance(),
+    but for any number of classmeetings at once (depends on doctests at top of file):
+    >>> cms = ClassMeeting.objects.filter(date=dict(PHASE_END_DATES)[1][1])
+    >>> rosters = ClassMeeting.objects.attendance_for(cms)
+    >>> [rosters[c.id] == c.attendance() for c in cms]
+    [True, True, True]
+    >>> ClassMeeting.objects.attendance_for([])
+    {}
+
+    Contiguous hours share a session, numbered by hour_index:
+    >>> [(c.session_id == cms[0].id, c.hour_index) for c in cms]
+    [(True, 0), (True, 1), (False, 0)]
+    >>> ClassMeeting.objects.session_lengths(cms) == {cms[0].id: 2, cms[2].id: 1}
+    True
+
+    Hours that have never been indexed are found by their start times instead:
+    >>> unindexed = ClassMeeting.objects.get(id=cms[1].id)
+    >>> unindexed.session_id = unindexed.hour_index = None
+    >>> unindexed.previous_hour_classmeeting().id == cms[0].id, unindexed.is_first_hour(), unindexed.number_of_hours()
+    (True, False, 2)
+
+    Deleting the first hour of a session leaves the later hours, as a session of their own:
+    >>> day = dict(PHASE_END_DATES)[1][1] + datetime.timedelta(days=3)
+    >>> hours = [ClassMeeting.objects.create(course=cms[0].course, section="T", room=cms[0].room, 
+    ...     date=day, time_start=datetime.time(hour, 0)) for hour in (8, 9, 10)]
+    >>> hours[0].delete()
+    >>> [(c.id == hours[1].id, c.session_id == hours[1].id, c.hour_index) for c in ClassMeeting.objects.filter(date=day)]
+    [(True, True, 0), (False, True, 1)]
+
+    Scans for a deleted class are kept, as loose scans:
+    >>> student = Person.objects.filter(kind=0)[0]
+    >>> scan = Scan.objects.create(person=student, classmeeting=hours[1],
+    ...     timestamp=datetime.datetime.combine(day, datetime.time(9, 5)))
+    >>> hours[1].delete(); hours[2].delete()
+    >>> Scan.objects.get(id=scan.id).classmeeting_id is None
+    True
+    >>> scan.delete()
+    """
+    def expected_for(self, classmeetings, inclusive=False):
+        """
+        Return a dict mapping ClassMeeting id to the list of students expected
+        in that class, i.e. PersonManager.section() for the class's section and
+        date. Uses one query for all the students, whatever the number of classmeetings.
+        """
+        today = datetime.date.today()
+        dates = set(c.date or today for c in classmeetings)
+        if not dates:
+            return {}
+        # Everyone who could be expected at any of these meetings, in the same
+        # order PersonManager.section() produces
+        candidates = sorted(Person.objects.enrolled(date=min(dates), inclusive=inclusive),
+            key=lambda p: (p.lastname, p.preferred_firstname))
+        # Resolve each student's section once per distinct date, not once per meeting
+        by_date_and_section = {}
+        for date in dates:
+            phases = {}
+            for person in candidates:
+                if person.id_expiry < date or (person.id_expiry == date and not inclusive):
+                    continue
+                if person.student_cohort not in phases:
+                    phases[person.student_cohort] = phase_for_cohort_and_date(person.student_cohort, date)
+                phase = phases[person.student_cohort]
+                letter = ""
+                if phase:
+                    letter = getattr(person, "student_sec_phase%d" % phase)
+                by_date_and_section.setdefault((date, letter), []).append(person)
+        return dict((c.id, by_date_and_section.get((c.date or today, c.section), []))
+            for c in classmeetings)
+
+    def attendance_for(self, classmeetings, inclusive=False):
+        """
+        Return a dict mapping ClassMeeting id to attendance lists (present, absent)
+        for every classmeeting given (a queryset or a list).
+
+        The number of queries is fixed (one for the meetings if a queryset is
+        passed, one for the students, one for the scans) no matter how many
+        classmeetings there are. The "inclusive" flag is passed along to
+        enrollment, as with PersonManager.section().
+        """
+        classmeetings = list(classmeetings)
+        if not classmeetings:
+            return {}
+        expected = self.expected_for(classmeetings, inclusive=inclusive)
+        # Note: scan_set uses the default manager (admin_objects), so we do too
+        scanned = {}
+        for scan in Scan.admin_objects.filter(classmeeting__in=expected.keys()).select_related():
+            scanned.setdefault(scan.classmeeting_id, []).append(scan.person)
+        result = {}
+        for c in classmeetings:
+            present = []
+            present_ids = set()
+            for person in sorted(scanned.get(c.id, []), key=lambda p: (p.lastname, p.preferred_firstname)):
+                if person.id not in present_ids:
+                    present_ids.add(person.id)
+                    present.append(person)
+            absent = [p for p in expected[c.id] if p.id not in present_ids]
+            result[c.id] = (present, absent)
+        return result
+
+    def in_session(self, section, when=None, scan_window=30):
+        """
+        Return the first hour of the class that the section is in (or is due in,
+        within `scan_window` minutes) at the given datetime (default: now), or None.
+        A class counts until 15 minutes after it ends, for scan-outs.
+        """
+        if when is None:
+            when = datetime.datetime.now()
+        lookahead = when + datetime.timedelta(minutes=scan_window)
+        if lookahead.date() != when.date():
+            lookahead = datetime.datetime.combine(when.date(), datetime.time(23, 59, 59))
+        try:
+            theclass = self.filter(section=section, date=when.date(), 
+                time_start__lte=lookahead.time()).order_by('-time_start')[0]
+        except IndexError:
+            return None
+        if theclass.datetime_end() + datetime.timedelta(minutes=15) < when:
+            return None
+        return theclass.first_hour_classmeeting()
+
+    def reindex_sessions(self, classmeetings, commit=True):
+        """
+        Recompute `session` and `hour_index` for the given classmeetings, which
+        should include every hour of each course/section/date they belong to. 
+        Only rows whose values change are written (and none if commit is False).
+        Returns the classmeetings, updated.
+        """
+        classmeetings = list(classmeetings)
+        groups = {}
+        for c in classmeetings:
+            if c.time_start is not None:
+                groups.setdefault((c.course_id, c.section, c.date), []).append(c)
+        updates = []
+        for group in groups.values():
+            by_start = {}
+            for c in group:
+                by_start.setdefault(c.time_start, c)
+            for c in group:
+                first, hour_index = c, 0
+                previous = by_start.get(adjacent_hour_start(first.time_start, -1))
+                while previous:
+                    first, hour_index = previous, hour_index + 1
+                    previous = by_start.get(adjacent_hour_start(first.time_start, -1))
+                if (c.session_id, c.hour_index) != (first.id, hour_index):
+                    c.session_id, c.hour_index = first.id, hour_index
+                    updates.append((first.id, hour_index, c.id))
+        if updates and commit:
+            cursor = connection.cursor()
+            cursor.executemany("UPDATE %s SET session_id = %%s, hour_index = %%s WHERE id = %%s" 
+                % ClassMeeting._meta.db_table, updates)
+            transaction.commit_unless_managed()
+        return classmeetings
+
+    def reindex_session_group(self, course_id, section, date):
+        """Recompute the session index for one course's hours for a section on a date"""
+        if date is None:
+            return []
+        return self.reindex_sessions(self.filter(course=course_id, section=section, date=date))
+
+    def session_lengths(self, classmeetings):
+        """
+        Return a dict mapping session (first-hour ClassMeeting id) to number of 
+        hours, for the sessions of the given classmeetings, in one grouped query.
+        """
+        session_ids = list(set(c.session_id for c in classmeetings if c.session_id))
+        if not session_ids:
+            return {}
+        cursor = connection.cursor()
+        cursor.execute("SELECT session_id, COUNT(*) FROM %s WHERE session_id IN (%s) GROUP BY session_id" 
+            % (ClassMeeting._meta.db_table, ", ".join(["%s"] * len(session_ids))), session_ids)
+        return dict(cursor.fetchall())
+
 
 class ClassMeeting(models.Model):
     """
@@ -502,6 +1351,14 @@ class ClassMeeting(models.Model):
         limit_choices_to={'kind': 2}, blank=True)
     room = models.ForeignKey(Room, blank=True)
     section = models.CharField(blank=True, max_length=1, choices=SECTION_CHOICES)
+    # Contiguous-hours index, maintained by save() and delete(): `session_id` is the 
+    # id of the first hour of the run of hours this one belongs to, `hour_index` 
+    # counts from 0. (A plain column, not a ForeignKey, since deleting a ForeignKey's
+    # target deletes everything pointing at it -- here, the rest of the session.)
+    session_id = models.IntegerField(blank=True, null=True, editable=False, db_index=True)
+    hour_index = models.SmallIntegerField(blank=True, null=True, editable=False)
+
+    objects = ClassMeetingManager()
 
     class Meta:
         verbose_name = "class meeting"
@@ -520,6 +1377,48 @@ class ClassMeeting(models.Model):
             self.time_start.strftime("%I:%M %p").lstrip("0"), 
             self.date)
 
+    def save(self):
+        """
+        Saving keeps the session index current, for this class's hours and any it
+        left, clears SCHEDULE_INDEX for the dates involved, and journals the 
+        change for the status feed.
+        """
+        old_group = None
+        if self.id:
+            try:
+                old = ClassMeeting.objects.get(id=self.id)
+                old_group = (old.course_id, old.section, old.date)
+            except ClassMeeting.DoesNotExist:
+                pass
+        super(ClassMeeting, self).save()
+        group = (self.course_id, self.section, self.date)
+        for c in ClassMeeting.objects.reindex_session_group(*group):
+            if c.id == self.id:
+                self.session_id, self.hour_index = c.session_id, c.hour_index
+        if old_group and old_group != group:
+            ClassMeeting.objects.reindex_session_group(*old_group)
+        SCHEDULE_INDEX.invalidate(self.date)
+        if old_group and old_group[2] != self.date:
+            SCHEDULE_INDEX.invalidate(old_group[2])
+        StatusChange.record(StatusChange.CLASS, classmeeting=self)
+
+    def delete(self):
+        """
+        Deleting a class detaches its scans and status journal entries first, 
+        rather than letting their ForeignKeys take them down with it.
+        """
+        group = (self.course_id, self.section, self.date)
+        cursor = connection.cursor()
+        for model in (Scan, StatusChange):
+            cursor.execute("UPDATE %s SET classmeeting_id = NULL WHERE classmeeting_id = %%s" 
+                % model._meta.db_table, [self.id])
+        super(ClassMeeting, self).delete()
+        ClassMeeting.objects.reindex_session_group(*group)
+        SCHEDULE_INDEX.invalidate(self.date)
+        bump_cache_version("scans.%s" % self.date)
+        StatusChange.record(StatusChange.CLASS, section=self.section)
+    delete = transaction.commit_on_success(delete)
+
     def lead_instructor(self):
         """Lead instructor"""
         return self.instructors[0]
@@ -547,26 +1446,39 @@ class ClassMeeting(models.Model):
         """
         Length of this classmeeting in hours (used in attendance reporting).
         """
-        class_length = 0
-        class_continues = self.first_hour_classmeeting()  # Count from first hour
-        while class_continues:
-            class_length += 1
-            class_continues = class_continues.next_hour_classmeeting()
+        if self.session_id is None:
+            # Not indexed yet: count the hours one by one
+            class_length = 0
+            class_continues = self.first_hour_classmeeting()
+            while class_continues:
+                class_length += 1
+                class_continues = class_continues.next_hour_classmeeting()
+        else:
+            class_length = ClassMeeting.objects.filter(session_id=self.session_id).count()
         if not 0 < class_length < 9:
             raise RuntimeError, "Class length calculation error: %s == %s hours?" % (self, class_length)
         return class_length        
     
     def is_not_first_hour(self):
-        return bool(self.previous_hour_classmeeting())
+        if self.hour_index is None:
+            return bool(self.previous_hour_classmeeting())
+        return bool(self.hour_index)
 
     def is_first_hour(self):
         return not self.is_not_first_hour()
 
     def first_hour_classmeeting(self):
-        proceed = True
+        if self.session_id == self.id:
+            return self
+        if self.session_id is not None:
+            try:
+                return ClassMeeting.objects.get(id=self.session_id)
+            except ClassMeeting.DoesNotExist:
+                pass
         theclass = self
-        while proceed and theclass.is_not_first_hour():
-            theclass = proceed = theclass.previous_hour_classmeeting()
+        previous = theclass.previous_hour_classmeeting()
+        while previous:
+            theclass, previous = previous, previous.previous_hour_classmeeting()
         return theclass
 
     def previous_hour_classmeeting(self):
@@ -582,18 +1494,21 @@ class ClassMeeting(models.Model):
         ClassMeeting object is found, return `None`.
         """
         step = step/abs(step)  # Don't allow multi-hour steps
-        adjacent_cm_start = datetime.time(self.time_start.hour + step, self.time_start.minute)
-        if self.time_start.hour + step == 12:
-            adjacent_cm_start = datetime.time(self.time_start.hour + 2 * step, self.time_start.minute)
+        if self.session_id is None or self.hour_index is None:
+            # Not indexed yet: look for the hour by its start time
+            adjacent_cm_start = adjacent_hour_start(self.time_start, step)
+            if adjacent_cm_start is None:
+                return None
+            neighbours = ClassMeeting.objects.filter(section=self.section, course=self.course,
+                date=self.date, time_start=adjacent_cm_start)
+        elif self.hour_index + step < 0:
+            return None
+        else:
+            neighbours = ClassMeeting.objects.filter(session_id=self.session_id, hour_index=self.hour_index + step)
         try:
-            result = ClassMeeting.objects.get(
-                section=self.section,
-                course=self.course,
-                date=self.date,
-                time_start=adjacent_cm_start)
-        except ClassMeeting.DoesNotExist:
-            result = None
-        return result
+            return neighbours[0]
+        except IndexError:
+            return None
     
     def datetime_start(self):
         """A datetime object for this class's start."""
@@ -623,15 +1538,9 @@ class ClassMeeting(models.Model):
     def attendance(self):
         """
         Return attendance lists (present, absent) for this class.
+        For more than one class, use ClassMeeting.objects.attendance_for().
         """
-        expected = Person.objects.section(self.section, date=self.date)
-        present_raw = sorted(s.person for s in self.scan_set.all())
-        present = []
-        for p in present_raw:
-            if p not in present:
-                present.append(p)
-        absent = [p for p in expected if p not in present]
-        return (present, absent)
+        return ClassMeeting.objects.attendance_for([self])[self.id]
 
     def section_ord(self):
         """
@@ -675,6 +1584,275 @@ class ClassMeeting(models.Model):
             )
 
 
+class ScheduleIndex(object):
+    """
+    Process-local index of each day's classes, answering "which class is this
+    section / instructor in at this time" with a bisect over start times rather
+    than a query. A day is loaded on first use, for past days as well as today.
+    ClassMeeting.save() and delete() clear the day here and bump its cache 
+    version so other processes reload it; since instructors are edited after
+    the class is saved, days are also reloaded every RELOAD_INTERVAL seconds.
+
+    (These depend on data saved from doctests at top of file.)
+    >>> eight_thirty = datetime.datetime(2009, 11, 6, 8, 30)
+    >>> SCHEDULE_INDEX.section_class("T", eight_thirty)
+    <ClassMeeting: Digital Hoohah, 8:00 AM 2009-11-06>
+    >>> SCHEDULE_INDEX.section_class("T", eight_thirty.replace(hour=7)) is None
+    True
+    >>> SCHEDULE_INDEX.instructor_class(Person.objects.instructors("Q")[0], eight_thirty)
+    <ClassMeeting: Digital Hoohah, 8:00 AM 2009-11-06>
+    """
+    RELOAD_INTERVAL = 300
+    MAX_DAYS = 31
+
+    def __init__(self):
+        self._days = {}
+
+    def _day(self, date):
+        """Return (sections, instructors) for the date, loading it if stale"""
+        version = cache_versions("classmeetings.%s" % date)[0]
+        entry = self._days.get(date)
+        if entry is None or entry[0] != version or entry[1] + self.RELOAD_INTERVAL < time.time():
+            if len(self._days) >= self.MAX_DAYS:
+                self._days.clear()
+            entry = (version, time.time()) + self._load(date)
+            self._days[date] = entry
+        return entry[2:]
+
+    def _load(self, date):
+        """
+        Build the day's lookup tables: per section, class start times with the
+        first hour of each class's session; per instructor id, class start times
+        with the classes themselves. Both are in schedule order.
+        """
+        classes = list(ClassMeeting.objects.filter(date=date).exclude(time_start=None).select_related())
+        by_id = dict((c.id, c) for c in classes)
+        sections = {}
+        for c in classes:
+            starts, first_hours = sections.setdefault(c.section, ([], []))
+            starts.append(c.datetime_start())
+            first_hours.append(by_id.get(c.session_id, c))
+        teaching = {}
+        if classes:
+            field = ClassMeeting._meta.get_field("instructors")
+            cursor = connection.cursor()
+            cursor.execute("SELECT %s, %s FROM %s WHERE %s IN (%s)" % (field.m2m_column_name(), 
+                field.m2m_reverse_name(), field.m2m_db_table(), field.m2m_column_name(), 
+                ", ".join(["%s"] * len(classes))), by_id.keys())
+            for classmeeting_id, person_id in cursor.fetchall():
+                teaching.setdefault(person_id, []).append(by_id[classmeeting_id])
+        order = dict((c.id, i) for i, c in enumerate(classes))
+        instructors = {}
+        for person_id, taught in teaching.items():
+            taught.sort(key=lambda c: order[c.id])
+            instructors[person_id] = ([c.datetime_start() for c in taught], taught)
+        return sections, instructors
+
+    def section_class(self, section, when=None):
+        """
+        The class the section is in at the given datetime (default: now) -- the 
+        first hour of the latest class to have started that day -- or None.
+        """
+        if when is None:
+            when = datetime.datetime.now()
+        sections, instructors = self._day(when.date())
+        starts, first_hours = sections.get(section, ([], []))
+        i = bisect.bisect_right(starts, when)
+        if i:
+            return first_hours[i - 1]
+        return None
+
+    def instructor_class(self, person, when=None):
+        """The class hour the instructor is teaching at the given datetime (default: now), or None"""
+        if when is None:
+            when = datetime.datetime.now()
+        sections, instructors = self._day(when.date())
+        starts, taught = instructors.get(person.id, ([], []))
+        for c in taught[:bisect.bisect_left(starts, when)]:
+            if c.datetime_end() > when:
+                return c
+        return None
+
+    def invalidate(self, date):
+        self._days.pop(date, None)
+        bump_cache_version("classmeetings.%s" % date)
+
+SCHEDULE_INDEX = ScheduleIndex()
+
+
+def class_interval(classmeeting):
+    """(start, end) datetimes of a class hour; without an end time, it's an hour long"""
+    start = datetime.datetime.combine(classmeeting.date, classmeeting.time_start)
+    if classmeeting.time_end:
+        return start, datetime.datetime.combine(classmeeting.date, classmeeting.time_end)
+    return start, start + datetime.timedelta(hours=1)
+
+
+class ScheduleConflict(object):
+    """A proposed class that overlaps another class in the same room, section or instructor"""
+
+    def __init__(self, resource, proposed, other, other_proposed):
+        self.resource = resource
+        self.proposed = proposed
+        self.other = other
+        self.other_proposed = other_proposed
+
+    def __unicode__(self):
+        return u"%s: %s overlaps %s%s" % (self.resource, self.proposed, self.other,
+            self.other_proposed and u" (also proposed)" or u"")
+
+
+class SchedulePlan(object):
+    """
+    A batch of new classmeetings, checked against the existing schedule and each
+    other all at once, and saved in one transaction. The existing classes for the
+    batch's dates are loaded with one query (and one more for their instructors),
+    and overlaps are found with a sweep over each room's, section's and 
+    instructor's classes in start-time order.
+
+    (These depend on data saved from doctests at top of file.)
+    >>> plan = SchedulePlan()
+    >>> course, room = Course.objects.all()[0], Room.objects.create(abbreviation="Lab")
+    >>> quimby = Person.objects.instructors("Q")[0]
+    >>> day = datetime.date(2009, 11, 6)
+    >>> for section in ["U", "V"]:
+    ...     plan.add(ClassMeeting(course=course, room=room, section=section, date=day,
+    ...         time_start=datetime.time(8, 0)), [quimby])
+    >>> for conflict in plan.conflicts():
+    ...     print unicode(conflict)
+    Room Lab: Digital Hoohah, 8:00 AM 2009-11-06 overlaps Digital Hoohah, 8:00 AM 2009-11-06 (also proposed)
+    Instructor Guest Instructor: Digital Hoohah, 8:00 AM 2009-11-06 overlaps Digital Hoohah, 8:00 AM 2009-11-06
+    Instructor Guest Instructor: Digital Hoohah, 8:00 AM 2009-11-06 overlaps Digital Hoohah, 8:00 AM 2009-11-06
+    Instructor Guest Instructor: Digital Hoohah, 8:00 AM 2009-11-06 overlaps Digital Hoohah, 8:00 AM 2009-11-06 (also proposed)
+    >>> plan.save()
+    Traceback (most recent call last):
+    ...
+    ValueError: 4 schedule conflicts
+
+    Without them, it saves, and the new classes form one session:
+    >>> plan = SchedulePlan()
+    >>> for hour in [10, 11]:
+    ...     plan.add(ClassMeeting(course=course, room=room, section="U", date=day,
+    ...         time_start=datetime.time(hour, 0)), [quimby])
+    >>> plan.conflicts()
+    []
+    >>> first, second = plan.save()
+    >>> second.first_hour_classmeeting().id == first.id, list(second.instructors.all())
+    (True, [<Person: Guest Instructor>])
+    >>> SCHEDULE_INDEX.instructor_class(quimby, datetime.datetime(2009, 11, 6, 11, 30)).id == second.id
+    True
+    >>> first.delete(); second.delete(); room.delete()
+    """
+
+    def __init__(self):
+        self.proposed = []      # (classmeeting, instructors)
+        self._conflicts = None
+
+    def add(self, classmeeting, instructors=()):
+        """Propose an unsaved classmeeting, taught by the given Person objects"""
+        self.proposed.append((classmeeting, list(instructors)))
+        self._conflicts = None
+
+    def _existing(self):
+        """The saved classes on the batch's dates, with {classmeeting id: [instructor ids]}"""
+        dates = [c.date for c, instructors in self.proposed]
+        existing = list(ClassMeeting.objects.filter(date__range=(min(dates), max(dates)))
+            .exclude(time_start=None).select_related())
+        teaching = {}
+        if existing:
+            field = ClassMeeting._meta.get_field("instructors")
+            cursor = connection.cursor()
+            cursor.execute("SELECT t.%s, t.%s FROM %s t INNER JOIN %s c ON c.id = t.%s WHERE c.date BETWEEN %%s AND %%s"
+                % (field.m2m_column_name(), field.m2m_reverse_name(), field.m2m_db_table(),
+                ClassMeeting._meta.db_table, field.m2m_column_name()), [min(dates), max(dates)])
+            for classmeeting_id, person_id in cursor.fetchall():
+                teaching.setdefault(classmeeting_id, []).append(person_id)
+        return existing, teaching
+
+    def conflicts(self):
+        """
+        Every ScheduleConflict in the batch, ordered by the resource's kind (rooms, 
+        sections, instructors) and then by time.
+        """
+        if self._conflicts is not None:
+            return self._conflicts
+        if not self.proposed:
+            return []
+        existing, teaching = self._existing()
+        # Intervals per resource: (start, end, order, classmeeting, is_proposed)
+        resources = {}
+        names = {}
+        def book(key, name, classmeeting, is_proposed):
+            start, end = class_interval(classmeeting)
+            intervals = resources.setdefault(key, [])
+            intervals.append((start, end, len(intervals), classmeeting, is_proposed))
+            if name is not None:
+                names[key] = name
+        for c in existing:
+            book((0, c.room_id), None, c, False)
+            book((1, c.section), None, c, False)
+            for person_id in teaching.get(c.id, []):
+                book((2, person_id), None, c, False)
+        for c, instructors in self.proposed:
+            book((0, c.room_id), u"Room %s" % c.room, c, True)
+            book((1, c.section), u"Section %s" % c.section, c, True)
+            for person in instructors:
+                book((2, person.id), u"Instructor %s" % person, c, True)
+        conflicts = []
+        for key in sorted(names):
+            if key[1] in (None, ""):
+                continue
+            active = []
+            for start, end, order, classmeeting, is_proposed in sorted(resources[key]):
+                active = [a for a in active if a[0] > start]
+                for other_end, other, other_proposed in active:
+                    if is_proposed:
+                        conflicts.append(ScheduleConflict(names[key], classmeeting, other, other_proposed))
+                    elif other_proposed:
+                        conflicts.append(ScheduleConflict(names[key], other, classmeeting, False))
+                active.append((end, classmeeting, is_proposed))
+        self._conflicts = conflicts
+        return conflicts
+
+    def save(self):
+        """
+        Save the proposed classmeetings and their instructors, or raise ValueError
+        if there are any conflicts. Returns the classmeetings.
+        """
+        conflicts = self.conflicts()
+        if conflicts:
+            raise ValueError, "%d schedule conflicts" % len(conflicts)
+        self._write()
+        return [c for c, instructors in self.proposed]
+
+    def _write(self):
+        # Rows are inserted with the plain model save; the upkeep ClassMeeting.save() 
+        # does per row is done once for the whole batch below
+        field = ClassMeeting._meta.get_field("instructors")
+        teaching = []
+        for c, instructors in self.proposed:
+            super(ClassMeeting, c).save()
+            teaching.extend([(c.id, person.id) for person in instructors])
+        cursor = connection.cursor()
+        if teaching:
+            cursor.executemany("INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (field.m2m_db_table(), 
+                field.m2m_column_name(), field.m2m_reverse_name()), teaching)
+        meetings = [c for c, instructors in self.proposed]
+        dates = [c.date for c in meetings]
+        groups = set((c.course_id, c.section, c.date) for c in meetings)
+        neighbours = ClassMeeting.objects.filter(date__range=(min(dates), max(dates)),
+            course__in=list(set(c.course_id for c in meetings)), section__in=list(set(c.section for c in meetings)))
+        indexed = dict((c.id, c) for c in ClassMeeting.objects.reindex_sessions(
+            [c for c in neighbours if (c.course_id, c.section, c.date) in groups]))
+        for c in meetings:
+            c.session_id, c.hour_index = indexed[c.id].session_id, indexed[c.id].hour_index
+        for date in set(dates):
+            SCHEDULE_INDEX.invalidate(date)
+        for section in set(c.section for c in meetings):
+            StatusChange.record(StatusChange.CLASS, section=section)
+    _write = transaction.commit_on_success(_write)
+
+
 class ScanManager(models.Manager):
     """
     Custom manager to return only non-signout scans only.
@@ -739,13 +1917,21 @@ class Scan(models.Model):
         blank=True, null=True,
         limit_choices_to={'date__gt': one_week_ago})
     is_signout = models.BooleanField(default=False)
+    is_kiosk = models.BooleanField(default=False, help_text="Scanned at the attendance kiosk (versus manual attendance)")
+    kiosk = models.CharField(blank=True, max_length=30, help_text="Which kiosk, if it identified itself")
+    client_key = models.CharField(blank=True, null=True, unique=True, max_length=60, editable=False,
+        help_text="Kiosk-assigned key that makes resubmitting a scan harmless")
+    repeat_count = models.PositiveIntegerField(default=0, editable=False,
+        help_text="Repeat scans at the same kiosk that were collapsed into this one")
+    last_seen = models.DateTimeField(blank=True, null=True, editable=False,
+        help_text="Time of the latest repeat scan, if any")
     admin_objects = models.Manager()
     objects = ScanManager()
     signouts = SignoutScanManager()
 
     class Admin:
-        list_display = ["precise_timestamp", "person_link", "classmeeting", "is_signout", "person_kind"]
-        list_filter = ["timestamp", "is_signout", "person"]
+        list_display = ["precise_timestamp", "person_link", "classmeeting", "is_signout", "is_kiosk", "person_kind"]
+        list_filter = ["timestamp", "is_signout", "is_kiosk", "person"]
         date_hierarchy = "timestamp"
         
     class Meta:
@@ -772,10 +1958,174 @@ class Scan(models.Model):
     
     def person_kind(self):
         return self.person.get_kind_display()
+
+    def save(self, old=None, bookkeeping=None):
+        """
+        Saving a class scan updates the AttendanceRecord for its classmeeting,
+        and any scan moves its person's last_scan_at forward. A caller that 
+        already has the scan as it was loaded can pass it as old, rather than
+        have it read again, and one saving a batch of scans can pass a 
+        ScanBookkeeping to make the batch's follow-up writes all at once.
+        """
+        if self.id and old is None:
+            try:
+                old = Scan.admin_objects.get(id=self.id)
+            except Scan.DoesNotExist:
+                pass
+        writes = bookkeeping or ScanBookkeeping()
+        super(Scan, self).save()
+        same_place = old and (old.classmeeting_id, old.person_id) == (self.classmeeting_id, self.person_id)
+        if self.classmeeting_id:
+            if not same_place or (self.timestamp <= old.timestamp and self.latest_time() >= old.latest_time()):
+                AttendanceRecord.extend(self.classmeeting_id, self.person_id, self.timestamp, self.latest_time())
+            else:
+                AttendanceRecord.refresh(self.classmeeting_id, self.person_id)
+        if old and old.classmeeting_id and not same_place:
+            AttendanceRecord.refresh(old.classmeeting_id, old.person_id)
+        if old and (old.person_id != self.person_id or self.latest_time() < old.latest_time()):
+            Person.objects.refresh_last_scan([old.person_id, self.person_id])
+        else:
+            writes.record_scan(self.person_id, self.latest_time())
+        dates = self._scan_dates()
+        if old and not same_place:
+            dates |= old._scan_dates()
+        elif old:
+            dates.add(old.timestamp.date())
+        for date in dates:
+            writes.bump("scans.%s" % date)
+        writes.bump("person.%s" % self.person_id)
+        if old and old.person_id != self.person_id:
+            writes.bump("person.%s" % old.person_id)
+        if not same_place:
+            self.record_status_change(writes)
+        if not bookkeeping:
+            writes.write()
+
+    def delete(self):
+        classmeeting_id, person_id = self.classmeeting_id, self.person_id
+        super(Scan, self).delete()
+        if classmeeting_id:
+            AttendanceRecord.refresh(classmeeting_id, person_id)
+        Person.objects.refresh_last_scan([person_id])
+        writes = ScanBookkeeping()
+        for date in self._scan_dates():
+            writes.bump("scans.%s" % date)
+        writes.bump("person.%s" % person_id)
+        self.record_status_change(writes)
+        writes.write()
+
+    def _scan_dates(self):
+        """Dates whose scans.<date> cache version this scan belongs to: its own, and its class's"""
+        dates = set([self.timestamp.date()])
+        if self.classmeeting_id:
+            dates.add(self.classmeeting.date)
+        return dates
+
+    def record_status_change(self, bookkeeping):
+        """Journal this scan for the status feed, under its class's section or the person's"""
+        if self.classmeeting_id:
+            bookkeeping.record_change(StatusChange.SCAN, classmeeting=self.classmeeting, person=self.person)
+        else:
+            bookkeeping.record_change(StatusChange.SCAN, person=self.person, 
+                section=self.person.section(self.timestamp.date()) or "")
+
+    def latest_time(self):
+        """When the person was last seen by this scan, counting collapsed repeats"""
+        return max(self.timestamp, self.last_seen or self.timestamp)
     
     def report_line(self, format="%H:%M:%S"):
         return "* %s %s" % (self.person, self.timestamp.strftime(format))
         
+    @classmethod
+    def from_kiosk(cls, id_number, timestamp=None, kiosk="", client_key=None, bookkeeping=None):
+        """
+        Record a scan from the attendance kiosk and return it. The person is found
+        via ID_NUMBER_INDEX (raising Person.DoesNotExist for unknown numbers), and
+        the scan is attached to the class the person's section is in, if any.
+
+        A repeat scan by the same person at the same kiosk within 
+        settings.SCAN_DEBOUNCE_SECONDS of an earlier one isn't stored as a new
+        row; the earlier scan's repeat_count and last_seen are updated instead,
+        and the repeat's client_key is kept as a ScanKey of the earlier scan.
+        The bookkeeping, if given, is passed on to Scan.save().
+        """
+        person = ID_NUMBER_INDEX.get(id_number)
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        window = datetime.timedelta(seconds=getattr(settings, "SCAN_DEBOUNCE_SECONDS", 120))
+        try:
+            earlier = cls.objects.filter(person=person, kiosk=kiosk, is_kiosk=True,
+                timestamp__gte=timestamp - window, timestamp__lte=timestamp).latest()
+        except cls.DoesNotExist:
+            earlier = None
+        if earlier:
+            old = copy.copy(earlier)
+            earlier.repeat_count += 1
+            earlier.last_seen = max(earlier.last_seen or timestamp, timestamp)
+            earlier.save(old=old, bookkeeping=bookkeeping)
+            if client_key:
+                ScanKey.objects.create(client_key=client_key, scan=earlier)
+            return earlier
+        classmeeting = None
+        if person.is_student():
+            classmeeting = ClassMeeting.objects.in_session(person.section(timestamp.date()), timestamp)
+        scan = cls(person=person, timestamp=timestamp, classmeeting=classmeeting, 
+            is_kiosk=True, kiosk=kiosk, client_key=client_key)
+        scan.save(bookkeeping=bookkeeping)
+        return scan
+
+    def from_kiosk_batch(cls, kiosk, entries):
+        """
+        Record a batch of kiosk scans in one transaction. Each entry is a dict
+        with "key" (unique per scan, assigned by the kiosk), "id_number" and 
+        "timestamp" (a datetime, taken when the student scanned). Returns a list
+        of (key, status, scan) in entry order, where status is "recorded",
+        "duplicate" (already recorded under that key) or "unknown" (no such ID
+        number); scan is None for unknown ID numbers. Their cache version bumps,
+        last_scan_at moves and status journal entries are made once, at the end.
+
+        >>> then = datetime.datetime(2009, 1, 2, 3, 4, 5)
+        >>> batch = [{'key': "k1-1", 'id_number': "1000666", 'timestamp': then},
+        ...     {'key': "k1-2", 'id_number': "9999999", 'timestamp': then}]
+        >>> [(key, status) for key, status, scan in Scan.from_kiosk_batch("k1", batch)]
+        [('k1-1', 'recorded'), ('k1-2', 'unknown')]
+        >>> [(key, status) for key, status, scan in Scan.from_kiosk_batch("k1", batch[:1])]
+        [('k1-1', 'duplicate')]
+
+        A quick second scan at the same kiosk is collapsed into the first, and
+        resending it changes nothing:
+        >>> batch = [{'key': "k1-3", 'id_number': "1000666", 'timestamp': then + datetime.timedelta(seconds=5)}]
+        >>> [(status, str(scan.client_key), scan.repeat_count) for key, status, scan in Scan.from_kiosk_batch("k1", batch)]
+        [('recorded', 'k1-1', 1)]
+        >>> [(status, str(scan.client_key), scan.repeat_count) for key, status, scan in Scan.from_kiosk_batch("k1", batch)]
+        [('duplicate', 'k1-1', 1)]
+        >>> Scan.admin_objects.get(client_key="k1-1").delete()
+        >>> ScanKey.objects.filter(client_key="k1-3").count()
+        0
+        """
+        bookkeeping = ScanBookkeeping()
+        keys = [entry['key'] for entry in entries]
+        already = dict((s.client_key, s) for s in cls.admin_objects.filter(client_key__in=keys))
+        for collapsed in ScanKey.objects.filter(client_key__in=keys).select_related():
+            already[collapsed.client_key] = collapsed.scan
+        results = []
+        for entry in entries:
+            key = entry['key']
+            if key in already:
+                results.append((key, "duplicate", already[key]))
+                continue
+            try:
+                scan = cls.from_kiosk(entry['id_number'], entry['timestamp'], kiosk=kiosk, client_key=key,
+                    bookkeeping=bookkeeping)
+            except Person.DoesNotExist:
+                results.append((key, "unknown", None))
+                continue
+            already[key] = scan
+            results.append((key, "recorded", scan))
+        bookkeeping.write()
+        return results
+    from_kiosk_batch = classmethod(transaction.commit_on_success(from_kiosk_batch))
+
     @classmethod
     def barcode_scans_for_date(cls, date):
         """
@@ -790,6 +2140,289 @@ class Scan(models.Model):
             'person__kind': STUDENT_KIND,
             }
         # Note: Raw SQL used here because 'classmeeting=None' in the ORM doesn't
-        # give the needed result, yet we need to return a queryset 
-        scans = cls.objects.filter(**filters).extra(where=["classmeeting_id is NULL"])
+        # give the needed result, yet we need to return a queryset. Kiosk scans
+        # that were matched to a class still count as barcode scans.
+        scans = cls.objects.filter(**filters).extra(where=["(classmeeting_id is NULL OR is_kiosk)"])
         return scans
+
+
+
+class ScanBookkeeping(object):
+    """
+    The writes that follow saving scans -- cache version bumps, last_scan_at
+    moves and status journal entries -- gathered by Scan.save() and made by 
+    write(), so that a batch of scans makes each of them once (and the journal
+    entries in one statement) rather than once per scan.
+    """
+    def __init__(self):
+        self.versions = set()
+        self.last_scans = {}
+        self.changes = []
+
+    def bump(self, name):
+        self.versions.add(name)
+
+    def record_scan(self, person_id, when):
+        self.last_scans[person_id] = max(when, self.last_scans.get(person_id, when))
+
+    def record_change(self, kind, classmeeting=None, person=None, section=None):
+        self.changes.append((kind, classmeeting, person, section))
+
+    def write(self):
+        Person.objects.record_scans(self.last_scans)
+        StatusChange.record_many(self.changes)
+        for name in self.versions:
+            bump_cache_version(name)
+        self.__init__()
+
+
+class ScanKey(models.Model):
+    """
+    The client_key of a kiosk scan that was collapsed into an earlier scan as a
+    repeat (see Scan.from_kiosk), so that resubmitting it is as harmless as 
+    resubmitting a scan that was stored.
+    """
+    client_key = models.CharField(unique=True, max_length=60)
+    scan = models.ForeignKey(Scan, related_name="collapsed_keys")
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.client_key, self.scan)
+
+
+class AttendanceRecordManager(models.Manager):
+    """
+    Custom manager methods for the AttendanceRecord class.
+    """
+    def attendance_for(self, classmeetings, inclusive=False):
+        """
+        Like ClassMeeting.objects.attendance_for(), but reading who was present
+        from the attendance records of each classmeeting. Absent students are 
+        the expected roster, less those present.
+        """
+        classmeetings = list(classmeetings)
+        if not classmeetings:
+            return {}
+        present_by_class = {}
+        records = self.filter(classmeeting__in=[c.id for c in classmeetings], status=AttendanceRecord.PRESENT)
+        for record in records.select_related():
+            present_by_class.setdefault(record.classmeeting_id, []).append(record.person)
+        expected = ClassMeeting.objects.expected_for(classmeetings, inclusive=inclusive)
+        result = {}
+        for c in classmeetings:
+            present = sorted(present_by_class.get(c.id, []), 
+                key=lambda p: (p.lastname, p.preferred_firstname))
+            present_ids = set(p.id for p in present)
+            result[c.id] = (present, [p for p in expected[c.id] if p.id not in present_ids])
+        return result
+
+
+class AttendanceRecord(models.Model):
+    """
+    Materialized attendance: one row per person present at a classmeeting, with
+    the person's first and last scan for it. As with ClassMeeting.attendance(), a
+    person is present at the hours they were scanned into, which for kiosk scans
+    is the first hour of the class. Nobody absent has a row: who is absent is the
+    expected roster less those present (see AttendanceRecordManager), since 
+    rosters change with sections and the phase calendar, which scans know nothing
+    about. Scan.save() and Scan.delete() keep these current; 
+    utility/rebuild_attendance.py recomputes them for a date range and checks 
+    them against the live calculation.
+
+    (These depend on data saved from doctests at top of file.)
+    >>> some_class = ClassMeeting.objects.all()[0]
+    >>> AttendanceRecord.objects.attendance_for([some_class])[some_class.id] == some_class.attendance()
+    True
+    >>> record = AttendanceRecord.objects.get(classmeeting=some_class)
+    >>> print record.person, record.get_status_display()
+    Pat Patson present
+    >>> record.first_scan <= record.last_scan
+    True
+    >>> AttendanceRecord.rebuild([some_class], commit=False)
+    []
+
+    A scan counts for its own hour only, as it does in the live calculation:
+    >>> second_hour = some_class.next_hour_classmeeting()
+    >>> AttendanceRecord.objects.attendance_for([second_hour])[second_hour.id] == second_hour.attendance()
+    True
+    >>> AttendanceRecord.objects.attendance_for([second_hour])[second_hour.id][0]
+    []
+
+    A stored record that disagrees with the scans is reported, and corrected:
+    >>> AttendanceRecord.objects.create(classmeeting=second_hour, person=record.person)
+    <AttendanceRecord: Pat Patson, Digital Hoohah, 9:00 AM 2009-11-06: present>
+    >>> [(c == second_hour.id, p == record.person_id, stored, live) for c, p, stored, live in AttendanceRecord.rebuild([second_hour])]
+    [(True, True, 1, 2)]
+    >>> AttendanceRecord.rebuild([second_hour], commit=False)
+    []
+    """
+    PRESENT, ABSENT = 1, 2
+    STATUS_CHOICES = [(PRESENT, "present"), (ABSENT, "absent")]
+
+    classmeeting = models.ForeignKey(ClassMeeting, related_name="attendance_records")
+    person = models.ForeignKey(Person)
+    status = models.SmallIntegerField(choices=STATUS_CHOICES, default=PRESENT)
+    first_scan = models.DateTimeField(blank=True, null=True)
+    last_scan = models.DateTimeField(blank=True, null=True)
+
+    objects = AttendanceRecordManager()
+
+    class Admin:
+        list_display = ["classmeeting", "person", "status", "first_scan", "last_scan"]
+        list_filter = ["status"]
+
+    class Meta:
+        ordering = ["classmeeting", "person"]
+        unique_together = [("classmeeting", "person")]
+
+    def __unicode__(self):
+        return u"%s, %s: %s" % (self.person, self.classmeeting, self.get_status_display())
+
+    @classmethod
+    def refresh(cls, classmeeting_id, person_id):
+        """
+        Bring the record for this person in this classmeeting up to date with 
+        their scans. A person whose scans have all been deleted loses their record.
+        """
+        times = []
+        for scan in Scan.admin_objects.filter(person=person_id, classmeeting=classmeeting_id):
+            times.extend([t for t in (scan.timestamp, scan.last_seen) if t])
+        if not times:
+            cls.objects.filter(classmeeting=classmeeting_id, person=person_id).delete()
+            return None
+        try:
+            record = cls.objects.get(classmeeting=classmeeting_id, person=person_id)
+        except cls.DoesNotExist:
+            record = cls(classmeeting_id=classmeeting_id, person_id=person_id)
+        record.status, record.first_scan, record.last_scan = cls.PRESENT, min(times), max(times)
+        record.save()
+        return record
+
+    @classmethod
+    def extend(cls, classmeeting_id, person_id, first, last):
+        """
+        Mark the person present in the classmeeting, widening the record's scan
+        times to take in first and last. That is all a new scan, or a repeat 
+        collapsed into one, can change, so unlike refresh() this doesn't reread 
+        the person's scans, and it writes nothing if the record already covers them.
+        """
+        try:
+            record = cls.objects.get(classmeeting=classmeeting_id, person=person_id)
+        except cls.DoesNotExist:
+            record = cls(classmeeting_id=classmeeting_id, person_id=person_id)
+        if record.id and record.first_scan <= first and record.last_scan >= last:
+            return record
+        record.status = cls.PRESENT
+        record.first_scan = min(record.first_scan or first, first)
+        record.last_scan = max(record.last_scan or last, last)
+        record.save()
+        return record
+
+    @classmethod
+    def rebuild(cls, classmeetings, commit=True):
+        """
+        Compare the stored records for the given classmeetings with the live 
+        calculation, ClassMeeting.objects.attendance_for(), then recompute them
+        from their scans. 
+        Return a list of (classmeeting_id, person_id, stored status, live status)
+        for every student whose stored status differed; with commit=False that
+        is all that happens.
+        """
+        classmeetings = list(classmeetings)
+        if not classmeetings:
+            return []
+        live = ClassMeeting.objects.attendance_for(classmeetings)
+        stored = cls.objects.attendance_for(classmeetings)
+        mismatches = []
+        for c in classmeetings:
+            live_present = set(p.id for p in live[c.id][0])
+            stored_present = set(p.id for p in stored[c.id][0])
+            for person_id in sorted(live_present ^ stored_present):
+                if person_id in live_present:
+                    mismatches.append((c.id, person_id, cls.ABSENT, cls.PRESENT))
+                else:
+                    mismatches.append((c.id, person_id, cls.PRESENT, cls.ABSENT))
+        if commit:
+            ids = [c.id for c in classmeetings]
+            rows = {}
+            for scan in Scan.admin_objects.filter(classmeeting__in=ids):
+                key = (scan.classmeeting_id, scan.person_id)
+                latest = max(scan.timestamp, scan.last_seen or scan.timestamp)
+                first, last = rows.get(key, (cls.PRESENT, scan.timestamp, latest))[1:]
+                rows[key] = (cls.PRESENT, min(first, scan.timestamp), max(last, latest))
+            cursor = connection.cursor()
+            table = cls._meta.db_table
+            cursor.execute("DELETE FROM %s WHERE classmeeting_id IN (%s)" 
+                % (table, ", ".join(["%s"] * len(ids))), ids)
+            cursor.executemany("INSERT INTO %s (classmeeting_id, person_id, status, first_scan, last_scan) VALUES (%%s, %%s, %%s, %%s, %%s)" % table,
+                [key + value for key, value in rows.items()])
+            transaction.commit_unless_managed()
+        return mismatches
+
+
+class StatusChangeManager(models.Manager):
+    def since(self, change_id):
+        """Entries after the given id, oldest first, with their classes and people"""
+        return self.filter(id__gt=change_id).select_related().order_by("id")
+
+
+class StatusChange(models.Model):
+    """
+    Journal of changes the status dashboard cares about, written by Scan and 
+    ClassMeeting saves and read by the status feed server (utility/status_feed.py),
+    which turns them into deltas for its clients. Old entries are pruned by the
+    feed server.
+
+    (These depend on data saved from doctests at top of file.)
+    >>> some_class = ClassMeeting.objects.all()[0]
+    >>> change = StatusChange.record(StatusChange.CLASS, classmeeting=some_class)
+    >>> print change.section
+    T
+    >>> [c.id for c in StatusChange.objects.since(change.id - 1)] == [change.id]
+    True
+    """
+    SCAN, CLASS = 1, 2
+    KIND_CHOICES = [(SCAN, "scan"), (CLASS, "class change")]
+
+    timestamp = models.DateTimeField(default=datetime.datetime.now)
+    kind = models.SmallIntegerField(choices=KIND_CHOICES)
+    section = models.CharField(blank=True, max_length=1)
+    classmeeting = models.ForeignKey(ClassMeeting, blank=True, null=True)
+    person = models.ForeignKey(Person, blank=True, null=True)
+
+    objects = StatusChangeManager()
+
+    class Meta:
+        ordering = ["id"]
+
+    def __unicode__(self):
+        return u"%s %s, section %s" % (self.timestamp, self.get_kind_display(), self.section)
+
+    @classmethod
+    def record(cls, kind, classmeeting=None, person=None, section=None):
+        """Add a journal entry; the section defaults to the class's"""
+        if section is None:
+            section = classmeeting and classmeeting.section or ""
+        return cls.objects.create(kind=kind, section=section, 
+            classmeeting=classmeeting, person=person)
+
+    @classmethod
+    def record_many(cls, entries):
+        """Add journal entries, each (kind, classmeeting, person, section) as for record(), in one statement"""
+        if not entries:
+            return
+        now = datetime.datetime.now()
+        rows = []
+        for kind, classmeeting, person, section in entries:
+            if section is None:
+                section = classmeeting and classmeeting.section or ""
+            rows.append((now, kind, section, classmeeting and classmeeting.id, person and person.id))
+        cursor = connection.cursor()
+        cursor.executemany("INSERT INTO %s (timestamp, kind, section, classmeeting_id, person_id) VALUES (%%s, %%s, %%s, %%s, %%s)"
+            % cls._meta.db_table, rows)
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def prune(cls, hours=24):
+        """Delete entries older than the given number of hours"""
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        cls.objects.filter(timestamp__lt=cutoff).delete()
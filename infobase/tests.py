@@ -14,7 +14,40 @@ class SmokeTest(TestCase):
     def test_pages(self):
         self.fetch("/", 404)
         self.fetch("/scan/", 200)
+        self.fetch("/scan/?kiosk=lobby-2", 200)
+        self.fetch("/scan/?kiosk=%3C/script%3E", 400)
         self.fetch("/attendance/", 302)
+        self.fetch("/scan/batch/", 405)
+        self.fetch("/report/noshow/2009/11/06/", 302)
+
+    def test_scan_batch(self):
+        """Batches from the kiosk journal get a result for every scan"""
+        batch = '{"kiosk": "test", "scans": [{"key": "test-1", "id_number": "0000000", "timestamp": "2009-09-08T07:45:12"}]}'
+        response = self.client.post("/scan/batch/", batch, content_type="application/json")
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnless('"unknown"' in response.content)
+        response = self.client.post("/scan/batch/", "not json", content_type="application/json")
+        self.failUnlessEqual(response.status_code, 400)
+        batch = '{"kiosk": "test", "scans": [{"key": "%s", "id_number": "0000000", "timestamp": "2009-09-08T07:45:12"}]}'
+        response = self.client.post("/scan/batch/", batch % ("k" * 61), content_type="application/json")
+        self.failUnlessEqual(response.status_code, 400)
+
+    def test_students_api(self):
+        """The students API streams JSON and answers conditional GETs"""
+        response = self.client.get("/api/students/", {'fields': "id_number,flags", 'limit': "10"})
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnless(response.content.startswith("["))
+        response = self.client.get("/api/students/", {'fields': "id_number,flags", 'limit': "10"}, 
+            HTTP_IF_NONE_MATCH=response["ETag"])
+        self.failUnlessEqual(response.status_code, 304)
+        self.fetch("/api/students/?fields=password", 400)
+        self.fetch("/api/students/?changed_since=yesterday", 400)
+
+    def test_range_apis(self):
+        """Class meeting, scan and attendance APIs send anonymous users to log in"""
+        for api in ["classmeetings", "scans", "attendance"]:
+            self.fetch("/api/%s/?start=2009-11-02&end=2009-11-06" % api, 302)
+            self.fetch("/api/%s/?start=2009-11-02&end=2009-11-06&format=csv&limit=5" % api, 302)
 
 ## TODO: to use this test, create a fixture with the account credentials
     # def test_access(self):
@@ -1,13 +1,20 @@
 import calendar
+import csv
 import datetime
+import md5
+import re
+from cStringIO import StringIO
+from email.Utils import formatdate, mktime_tz, parsedate_tz
 import django.newforms as forms
 from django.contrib.auth.decorators import login_required
-from django.core import serializers
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseNotModified, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response
-from django.views.decorators.cache import cache_page
-from infobase.models import Course, ClassMeeting, Flag, Person, Room, Scan, phase_for_cohort_and_date
-from infobase.models import SECTIONS, SECTION_CHOICES, STUDENT_KIND, FACULTY_KIND
+from django.utils import simplejson
+from django.utils.dateformat import time_format
+from infobase.models import AttendanceRecord, Course, ClassMeeting, Flag, Person, Room, Scan, ScanBookkeeping, SchedulePlan, cache_versions, cached_fragment, cached_fragments, closing_connection, phase_for_cohort_and_date, start_of_day
+from infobase.models import SCHEDULE_INDEX, SECTIONS, SECTION_CHOICES, STUDENT_KIND, FACULTY_KIND
 
 def _calendar_data(mode="report", date=None):
     today = datetime.date.today()
@@ -26,25 +33,109 @@ def _calendar_data(mode="report", date=None):
         'today': highlight_day or None
         }
         
+# Kiosk names end up in scan keys and in the kiosk page's script
+KIOSK_NAME = re.compile(r"^[\w.-]{0,30}$")
+
+def _script_literal(value):
+    """value as a JavaScript literal that is safe inside a <script> element"""
+    return simplejson.dumps(value).replace("&", "\\u0026").replace("<", "\\u003c").replace(">", "\\u003e")
+
+def _json_response(data):
+    return HttpResponse(simplejson.dumps(data), mimetype="application/json")
+
+def _scan_summary(scan, photo_url):
+    """What the kiosk page's script needs to show for a scan from its journal"""
+    person = scan.person
+    return {
+        'person': unicode(person),
+        'id_number': person.id_number,
+        'photo_url': photo_url,
+        'time': time_format(scan.timestamp, "h:i:s a"),
+        'classmeeting': scan.classmeeting_id and unicode(scan.classmeeting) or None,
+        'preferred_firstname': person.preferred_firstname,
+        'birthday': bool(person.date_of_birth and person.happy_birthday()),
+        }
+
 def scan(request):
-    """Process a scan"""
+    """
+    The kiosk page. Its script sends scans to scan_batch(); browsers that can't
+    run it POST each scan here, and get the whole page back.
+    """
+    kiosk = request.GET.get('kiosk', "")
+    if not KIOSK_NAME.match(kiosk):
+        return HttpResponse("Kiosk names are up to 30 letters, digits, '.', '-' or '_'", status=400)
+    kiosk_literal = _script_literal(kiosk or "kiosk")
     if request.method == 'POST':
         id_number = request.POST['id_number']
         try:
-            person = Person.objects.get(id_number=id_number)
+            scan = Scan.from_kiosk(id_number, kiosk=kiosk)
         except Person.DoesNotExist:
             warning = "ID number not found!"
             return render_to_response("scan.html", locals())
-        # we can just record a raw scan for now, but it would be nice
-        # to figure out right here what class is meeting and add that to the "Scan" record
-        timestamp = datetime.datetime.now()
-        scan = Scan(person=person, timestamp=timestamp)
-        scan.save()
         last_scan = scan
+        photo_url = scan.person.id_photo_url()
     return render_to_response("scan.html", locals())
 
+def scan_batch(request):
+    """
+    Accept a batch of kiosk scans, POSTed as JSON by the kiosk page's journal:
+    
+        {"kiosk": "lobby", "scans": [{"key": "lobby-...", "id_number": "2009123", 
+            "timestamp": "2009-09-08T07:45:12"}, ...]}
+
+    The scans are recorded in one transaction, and each one's key makes
+    resubmitting it harmless. The response lists a result for every key, so 
+    the kiosk knows what it can drop from its journal. A key longer than 
+    Scan.client_key can hold gets the whole batch rejected, since a shortened 
+    key would never match the kiosk's.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    max_key_length = Scan._meta.get_field("client_key").max_length
+    try:
+        batch = simplejson.loads(request.raw_post_data)
+        kiosk = batch.get('kiosk', "")
+        if not KIOSK_NAME.match(kiosk):
+            return HttpResponse("Malformed kiosk name", status=400)
+        entries = []
+        for entry in batch['scans']:
+            timestamp = datetime.datetime.strptime(entry['timestamp'], "%Y-%m-%dT%H:%M:%S")
+            if len(entry['key']) > max_key_length:
+                return HttpResponse("Scan key longer than %d characters" % max_key_length, status=400)
+            entries.append({'key': entry['key'], 'id_number': entry['id_number'], 'timestamp': timestamp})
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return HttpResponse("Malformed scan batch", status=400)
+    results = []
+    for key, status, scan in Scan.from_kiosk_batch(kiosk, entries):
+        result = {'key': key, 'status': status}
+        if scan:
+            result['scan'] = _scan_summary(scan, scan.person.id_photo_url())
+        else:
+            result['warning'] = "ID number not found!"
+        results.append(result)
+    return _json_response({'results': results})
+
+def _roster(section, date):
+    """Students in the section as of date, cached until one of them or the phase calendar changes"""
+    return cached_fragment("roster.%s.%s" % (section, date), ["section.%s" % section, "phases"],
+        lambda: list(Person.objects.section(section, date)))
+
+def _attendance_for(classmeetings):
+    """
+    ClassMeeting.objects.attendance_for(), cached per class until a scan that 
+    day, a change to the section, or a change to that day's schedule. The 
+    classes that aren't cached are worked out together, in one call.
+    """
+    by_name = dict(("attendance.%s" % c.id, c) for c in classmeetings)
+    fragments = dict((name, ["scans.%s" % c.date, "section.%s" % c.section, "phases", "classmeetings.%s" % c.date])
+        for name, c in by_name.items())
+    def build(names):
+        rosters = ClassMeeting.objects.attendance_for([by_name[name] for name in names])
+        return dict((name, rosters[by_name[name].id]) for name in names)
+    rosters = cached_fragments(fragments, build)
+    return dict((c.id, rosters["attendance.%s" % c.id]) for c in classmeetings)
+
 @login_required
-@cache_page(30)
 def attendance(request, class_id=None, year=None, month=None, day=None):
     """On-screen attendance form for use by instructors"""
     cal = _calendar_data(mode="attendance")
@@ -55,7 +146,10 @@ def attendance(request, class_id=None, year=None, month=None, day=None):
     elif class_id == None:
         listdate = datetime.date.today()
     if listdate:
-        classmeetings = [c for c in ClassMeeting.objects.filter(date=listdate) if not c.is_open()]
+        # Instructors are saved after their class, so this also expires on a timer
+        classmeetings = cached_fragment("classlist.%s" % listdate, ["classmeetings.%s" % listdate],
+            lambda: [c for c in ClassMeeting.objects.filter(date=listdate) if not c.is_open()], 
+            timeout=SCHEDULE_INDEX.RELOAD_INTERVAL)
         return render_to_response("classlist.html", locals())
         
     # If no list, try to find a specific class by class_id
@@ -70,25 +164,28 @@ def attendance(request, class_id=None, year=None, month=None, day=None):
         
     # if this form was POSTed, it must be attendance data
     if request.method == "POST":
+        bookkeeping = ScanBookkeeping()
         for field, value in request.POST.items():
             if field.startswith("present_"):
                 student_id = int(field[8:])
                 student = Person.objects.get(pk=student_id)
                 timestamp = datetime.datetime.now()  # TODO: should probably be official class start-time
                 scan = Scan(person=student, timestamp=timestamp, classmeeting=theclass)
-                scan.save()
+                scan.save(bookkeeping=bookkeeping)
+        bookkeeping.write()
         return HttpResponse("Attendance for <b>%s, Section %s</b> has been recorded. Thank you!<br><br><a href='/attendance/'>Back to class list</a>" % (theclass.course, theclass.section))
         
     # if we've reached this point, we have a GET request with a class_id
-    students = Person.objects.section(theclass.section, theclass.date)
+    students = _roster(theclass.section, theclass.date)
     return render_to_response("checklist.html", locals())
 
 @login_required
 def report(request, class_id=None, year=None, month=None, day=None, person_id=None):
     if person_id:
         person = Person.objects.get(id_number=person_id)
+        inclass = None
         if person.is_student():
-            inclass = _where_is_section(person.section)
+            inclass = SCHEDULE_INDEX.section_class(person.section())
             try:
                 last_scan = Scan.objects.filter(person=person).latest()
             except Scan.DoesNotExist:
@@ -96,9 +193,11 @@ def report(request, class_id=None, year=None, month=None, day=None, person_id=No
             if not inclass:
                 message = "Not scheduled for class"
         elif person.is_faculty():
-            inclass = _where_is_instructor(person)
+            inclass = SCHEDULE_INDEX.instructor_class(person)
             if not inclass:
                 message = "Not scheduled for class"
+        if inclass:
+            present, absent = AttendanceRecord.objects.attendance_for([inclass])[inclass.id]
         return render_to_response("whereis.html", locals())
     if not class_id:
         listdate = datetime.date.today()
@@ -111,63 +210,37 @@ def report(request, class_id=None, year=None, month=None, day=None, person_id=No
         theclass = ClassMeeting.objects.get(pk=class_id)
     except ClassMeeting.DoesNotExist:
         return HttpResponse("Can't find that class!")
-    present, absent = theclass.attendance()
+    present, absent = AttendanceRecord.objects.attendance_for([theclass])[theclass.id]
     title = "Report for %s" % theclass
     return render_to_response("class_report.html", locals())
 
-def _where_is_section(section):
-    """If this section is in class right now, which class is it?"""
-    date_time = datetime.datetime.now()
-    try:
-        theclass = ClassMeeting.objects.filter(
-            section=section, 
-            date=date_time.date(), 
-            time_start__lte=date_time.time()
-            ).order_by('-time_start')[0]
-    except IndexError:
-        return None
-    return theclass.first_hour_classmeeting()
-    
-def _where_is_instructor(person):
-    """If this instructor is in class right now, which class is it?"""
-    classes_today = ClassMeeting.objects.filter(date=datetime.date.today())
-    the_class = [c for c in classes_today 
-        if c.has_started() and not c.is_over()
-        and person in c.instructors.all()]
-    if the_class:
-        return the_class[0]
-
 @login_required
-@cache_page(60)
 def status(request):
     scheduled_classes = []
     for section in SECTIONS:
-        theclass = _where_is_section(section)
+        theclass = SCHEDULE_INDEX.section_class(section)
         if theclass:
             scheduled_classes.append((section, theclass))
+    rosters = _attendance_for(c for s, c in scheduled_classes)
+    scheduled_classes = [(s, c, rosters[c.id]) for s, c in scheduled_classes]
     title = "Status"
     return render_to_response("status.html", locals())
 
 @login_required
-@cache_page(60)
-def noshow(request):
-    """List people who haven't been marked present recently"""
-    today = datetime.date.today()
-    noshows = []
-    for days_back in range(7):
-        date = today - datetime.timedelta(days=days_back)
-        if date.isoweekday() < 6:   # don't show weekends
-            not_seen = list(Person.objects.not_seen_since(date))
-            mia_people = [p for p in not_seen if not p.is_on_leave(date)]
-            loa_people = [p for p in not_seen if p.is_on_leave(date)]
-            mia_people.sort(lambda a, b: cmp(a.section_ord(), b.section_ord()))
-            loa_people.sort(lambda a, b: cmp(a.section_ord(), b.section_ord()))
-            noshows.append((date, mia_people, loa_people))
+def noshow(request, year=None, month=None, day=None):
+    """List people who haven't been marked present in the week up to a date (default today)"""
+    if year and month and day:
+        end_date = datetime.date(int(year), int(month), int(day))
+    else:
+        end_date = datetime.date.today()
+    # Rebuilt only when a person or the phase calendar changes, or there's a scan on one of the days
+    dates = [end_date - datetime.timedelta(days=n) for n in range(7)]
+    noshows = cached_fragment("noshow.%s" % end_date, ["people", "phases"] + ["scans.%s" % d for d in dates],
+        lambda: Person.objects.noshows(end_date), timeout=24 * 60 * 60)
     title = "No-Show Report"
     return render_to_response("noshows.html", locals())
 
 @login_required
-@cache_page(60)
 def student_report(request, student_id=None, date=None):
     """Info on an individual student"""
     if student_id == None:
@@ -178,34 +251,40 @@ def student_report(request, student_id=None, date=None):
     if date == None:
         date = datetime.date.today()
     week_back = date- datetime.timedelta(days=7)
-    meetings = ClassMeeting.objects.filter(
-        date__gte=week_back, 
-        date__lte=date, 
-        section=section
-        ).order_by('date', 'time_start')
-    # TODO: should filter out classes that are in the future!
+    schedule_versions = ["classmeetings.%s" % (week_back + datetime.timedelta(days=n)) for n in range(8)]
+    meetings = cached_fragment("student_report.meetings.%s.%s" % (section, date), schedule_versions,
+        lambda: [m for m in ClassMeeting.objects.filter(
+            date__gte=week_back, 
+            date__lte=date, 
+            section=section
+            ).order_by('date', 'time_start') if m.is_first_hour()])
+    meetings = [m for m in meetings if m.is_over()]
+    present_classes = cached_fragment("student_report.present.%s.%s" % (student.id, date), 
+        ["person.%s" % student.id] + schedule_versions,
+        lambda: set(r.classmeeting_id for r in AttendanceRecord.objects.filter(person=student, 
+            status=AttendanceRecord.PRESENT, classmeeting__date__gte=week_back, classmeeting__date__lte=date)))
     report = []
     for meeting in meetings:
-        if meeting.is_first_hour() and meeting.is_over():
-            present, absent = meeting.attendance()
-            report.append((meeting, "Present" if student in present else "Absent"))
+        report.append((meeting, "Present" if meeting.id in present_classes else "Absent"))
     return render_to_response("student_report.html", locals())
 
 
-@cache_page(300)
 def faces(request, section=None):
     """Dynamic facesheet"""
     sections = SECTIONS
+    today = datetime.date.today()
     if not section:
-        people = Person.objects.enrolled()
+        people = cached_fragment("faces.students.%s" % today, ["people"],
+            lambda: list(Person.objects.enrolled()))
         label = "Students"
     elif section == "employees":
-        people = Person.objects.exclude(kind=Person.PEOPLE_TYPES_MAPPING['Student'])
+        people = cached_fragment("faces.employees", ["people"],
+            lambda: list(Person.objects.exclude(kind=Person.PEOPLE_TYPES_MAPPING['Student'])))
         label = "Faculty and Staff"
     else:
-        people = Person.objects.section(section)
+        people = _roster(section, today)
         label = "Section %s" % section
-        location = _where_is_section(section)
+        location = SCHEDULE_INDEX.section_class(section)
     title = "Faces"
     return render_to_response("faces.html", locals())
 
@@ -237,53 +316,69 @@ def flagged_people(request, flag_name):
             title = "%s List" % flag
         except Flag.DoesNotExist:
             raise Http404
-        people = flag.person_set.all()
+        people = Person.objects.load_flags(flag.person_set.all())
     else:
         # No flag specified, so offer a list of all flags that are in use
-        flags = [f for f in Flag.objects.all() 
-            if f.person_set.count() 
+        counts = Flag.objects.usage_counts()
+        flags = [(f, counts[f.id]) for f in Flag.objects.all() 
+            if f.id in counts
             and f.label.lower() != "test"]
     return render_to_response("flagged_people.html", locals())
 
 
+def _course_choices():
+    return cached_fragment("schedule_builder.courses", ["courses"],
+        lambda: [(c.id, str(c)) for c in Course.objects.filter(current=True)])
+
+
+def _instructor_choices():
+    return cached_fragment("schedule_builder.instructors", ["people"],
+        lambda: [(p.instructor_letter, str(p)) for p in Person.objects.filter(kind=FACULTY_KIND)])
+
+
+def _room_choices():
+    return cached_fragment("schedule_builder.rooms", ["rooms"],
+        lambda: [(r.id, str(r)) for r in Room.objects.all()])
+
+
 class ScheduleBuilderForm(forms.Form):
-    _courses = [(c.id, str(c)) for c in Course.objects.filter(current=True)]
+    """
+    Course, room and instructor choices are looked up (from the cache, usually)
+    each time a form is made, not when this module is imported.
+    """
     _hours = [(x, "%s:00" % (x % 12)) for x in [8,9,10,11,13,14,15,16]]
     _lengths = [(x, "%s hours" % x) for x in [1,2,3,4]]
-    _instructors = [(p.instructor_letter, str(p)) for p in Person.objects.filter(kind=FACULTY_KIND)]
-    _rooms = [(r.id, str(r)) for r in Room.objects.all()]
-    course = forms.ChoiceField(choices=_courses)
+    course = forms.ChoiceField()
     start_time = forms.ChoiceField(choices=_hours)
     length = forms.ChoiceField(choices=_lengths)
-    room = forms.ChoiceField(choices=_rooms)
+    room = forms.ChoiceField()
     sections = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple, choices=SECTION_CHOICES)
-    instructors = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple, choices=_instructors, required=False)
+    instructors = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple, required=False)
 
+    def __init__(self, *args, **kwargs):
+        super(ScheduleBuilderForm, self).__init__(*args, **kwargs)
+        self.fields['course'].choices = _course_choices()
+        self.fields['room'].choices = _room_choices()
+        self.fields['instructors'].choices = _instructor_choices()
 
-def _create_classmeetings(data, date):
+
+def _plan_classmeetings(data, date):
     """
-    From the provided data (a form submission), build a list of ClassMeeting objects
-    and return them.
+    From the provided data (a form submission), build a SchedulePlan of the 
+    ClassMeeting objects it asks for: every hour, for every section.
     """
     course = Course.objects.get(id=int(data['course']))
     start_time = int(data['start_time'])
     length = int(data['length'])
-    instructors = Person.objects.instructors(data['instructors'])
+    instructors = Person.objects.filter(kind=FACULTY_KIND, instructor_letter__in=data['instructors'])
     room = Room.objects.get(id=int(data['room']))
+    plan = SchedulePlan()
     for hour in range(start_time, start_time + length):
         time = datetime.time(hour, 0)
         for section in data['sections']:
-            # Find conflicts. Could be streamlined with Q objects, adding instructor check
-            conflicts = ClassMeeting.objects.filter(date=date, time_start=time, section=section).count()
-            conflicts += ClassMeeting.objects.filter(date=date, time_start=time, room=room).count()
-            if conflicts:
-                raise ValueError, "Conflict found with submitted classmeetings"
-            meeting = ClassMeeting(date=date, time_start=time, course=course, room=room, section=section)
-            print "Saving", meeting
-            meeting.save()
-            for instructor in instructors:
-                meeting.instructors.add(instructor)
-    return True
+            plan.add(ClassMeeting(date=date, time_start=time, course=course, room=room, section=section),
+                instructors)
+    return plan
 
 @login_required
 def schedule_builder(request, datestring):
@@ -292,13 +387,15 @@ def schedule_builder(request, datestring):
     """
     schedule_date = None
     if datestring:
-        schedule_date = datetime.datetime.strptime(datestring, "%Y-%m-%d")
+        schedule_date = datetime.datetime.strptime(datestring, "%Y-%m-%d").date()
         
     if request.method == "POST":
         submitted_form = ScheduleBuilderForm(request.POST)
         if submitted_form.is_valid():
-            data = submitted_form.cleaned_data
-            _create_classmeetings(data, schedule_date)
+            plan = _plan_classmeetings(submitted_form.cleaned_data, schedule_date)
+            conflicts = plan.conflicts()
+            if not conflicts:
+                plan.save()
     elif request.method == "GET":
         builder_form = ScheduleBuilderForm()
         if not schedule_date:
@@ -321,13 +418,302 @@ def schedule_builder(request, datestring):
     
 # API views
 
+API_CHUNK = 500             # rows fetched per query while streaming
+ATTENDANCE_API_CHUNK = 100  # classes per page of attendance (each page is three queries)
+API_MAX_DAYS = 92           # longest date range the range APIs serve: a phase, with room to spare
+# last_scan_at is left out: scans don't touch modified_at, so changed_since couldn't follow it
+STUDENT_API_FIELDS = [f.name for f in Person._meta.fields if f.name not in ("id", "last_scan_at")] + ["flags"]
+CLASSMEETING_API_COLUMNS = ["id", "date", "time_start", "time_end", "course_id", "course_number", 
+    "course", "section", "room", "session_id", "hour_index", "instructors"]
+SCAN_API_COLUMNS = ["id", "timestamp", "last_seen", "person_id", "id_number", "lastname", "firstname",
+    "classmeeting_id", "is_signout", "is_kiosk", "kiosk"]
+ATTENDANCE_API_COLUMNS = ["class_id", "date", "time_start", "section", "course", "person_id", 
+    "id_number", "lastname", "firstname", "status"]
+
+def _api_conditional(request, version_names):
+    """
+    ETag and Last-Modified values for an API response built from the named cache
+    versions, and whether the request's conditional headers say the client's
+    copy is still current.
+    """
+    versions = cache_versions(*version_names)
+    etag = '"%s"' % md5.new("%r %s" % (versions, request.get_full_path())).hexdigest()
+    last_modified = int(max(versions))
+    if "HTTP_IF_NONE_MATCH" in request.META:
+        return etag, last_modified, etag in [t.strip() for t in request.META["HTTP_IF_NONE_MATCH"].split(",")]
+    since = parsedate_tz(request.META.get("HTTP_IF_MODIFIED_SINCE", "").split(";")[0])
+    return etag, last_modified, since is not None and mktime_tz(since) >= last_modified
+
+def _api_paging(request):
+    """The (after, limit) keyset paging parameters; raises ValueError if malformed"""
+    after = int(request.GET.get("after", 0))
+    limit = None
+    if request.GET.get("limit"):
+        limit = int(request.GET["limit"])
+        if limit < 1:
+            raise ValueError
+    return after, limit
+
+def _api_dates(request):
+    """
+    The dates from the "start" and "end" parameters (YYYY-MM-DD, inclusive; start
+    defaults to today and end to start). Raises ValueError if malformed, backwards,
+    or longer than API_MAX_DAYS.
+    """
+    start = end = datetime.date.today()
+    if request.GET.get("start"):
+        start = end = datetime.datetime.strptime(request.GET["start"], "%Y-%m-%d").date()
+    if request.GET.get("end"):
+        end = datetime.datetime.strptime(request.GET["end"], "%Y-%m-%d").date()
+    if end < start or (end - start).days >= API_MAX_DAYS:
+        raise ValueError
+    return [start + datetime.timedelta(days=n) for n in range((end - start).days + 1)]
+
+def _api_pages(queryset, after, limit, size=API_CHUNK, key=lambda row: row.id):
+    """
+    Yield lists of rows from queryset in id order, starting after the given id
+    and stopping after limit rows (if any) -- one query per list of up to size
+    rows, however many there are in all.
+    """
+    sent = 0
+    while limit is None or sent < limit:
+        if limit is not None:
+            size = min(size, limit - sent)
+        page = list(queryset.filter(id__gt=after).order_by("id")[:size])
+        if not page:
+            return
+        yield page
+        sent += len(page)
+        after = key(page[-1])
+        if len(page) < size:
+            return
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return " ".join([_csv_value(v) for v in value])
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def _api_response(request, rows, columns, version_names):
+    """
+    Stream rows (dicts, from a generator) as JSON, or as CSV with a header line
+    if the request asks for format=csv; with ETag and Last-Modified headers for
+    the named cache versions, or 304 Not Modified.
+    """
+    etag, last_modified, not_modified = _api_conditional(request, version_names)
+    if not_modified:
+        response = HttpResponseNotModified()
+    elif request.GET.get("format") == "csv":
+        response = HttpResponse(closing_connection(_stream_csv(rows, columns)), mimetype="text/csv")
+    else:
+        response = HttpResponse(closing_connection(_stream_json(rows, columns)), mimetype="application/json")
+    response["ETag"] = etag
+    response["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    return response
+
+def _stream_json(rows, columns):
+    encoder = DjangoJSONEncoder()
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + encoder.encode(dict((c, row[c]) for c in columns))
+        separator = ", "
+    yield "]"
+
+def _stream_csv(rows, columns):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_value(row[c]) for c in columns])
+        if buffer.tell() > 8192:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _stream_students(students, fields, after, limit):
+    """
+    Yield students as JSON in the serializer's format, in id order, fetching
+    API_CHUNK at a time by id so that no query or buffer grows with the 
+    number of students.
+    """
+    columns = [f for f in fields if f != "flags"]
+    flags = Person._meta.get_field("flags")
+    encoder = DjangoJSONEncoder()
+    yield "["
+    separator = ""
+    for rows in _api_pages(students.values("id", *columns), after, limit, key=lambda row: row['id']):
+        if "flags" in fields:
+            for row in rows:
+                row['flags'] = []
+            by_id = dict((row['id'], row) for row in rows)
+            cursor = connection.cursor()
+            cursor.execute("SELECT %s, %s FROM %s WHERE %s IN (%s) ORDER BY %s" % (flags.m2m_column_name(),
+                flags.m2m_reverse_name(), flags.m2m_db_table(), flags.m2m_column_name(), 
+                ", ".join(["%s"] * len(rows)), flags.m2m_reverse_name()), by_id.keys())
+            for person_id, flag_id in cursor.fetchall():
+                by_id[person_id]['flags'].append(flag_id)
+        for row in rows:
+            pk = row.pop('id')
+            yield separator + encoder.encode({'pk': pk, 'model': "infobase.person", 'fields': row})
+            separator = ", "
+    yield "]"
+
 def students_api(request):
     """
-    Return Person data for all students, in JSON format.
+    Return Person data for students, in JSON (the format of Django's serializer),
+    streamed in id order. Optional GET parameters:
+
+        fields          comma-separated fields to include (default: all)
+        section         only students in the section (on "date", or today)
+        cohort          only students in the cohort
+        date            only students enrolled on the date (YYYY-MM-DD)
+        changed_since   only students saved at or after the time
+                        (YYYY-MM-DDTHH:MM:SS); for incremental syncs, pass the 
+                        latest modified_at from the previous sync
+        after, limit    keyset paging: at most "limit" students with ids above
+                        "after"; for the next page, pass the last id received
+
+    Responses carry an ETag and Last-Modified, and conditional GETs are answered
+    with 304 Not Modified until some Person is saved or deleted. Students are 
+    retired by their id_expiry rather than deleted, so changed_since does not 
+    report deletions.
     """
-    # No custom filters yet, but could be passed via request.GET and parsed here
-    filters = {}  
-    filters.update({'kind': STUDENT_KIND})
-    students = Person.objects.filter(**filters)
-    data = serializers.serialize("json", students)
-    return HttpResponse(data, mimetype="application/json")
+    etag, last_modified, not_modified = _api_conditional(request, ["people"])
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            fields = STUDENT_API_FIELDS
+            if request.GET.get("fields"):
+                fields = request.GET["fields"].split(",")
+                if [f for f in fields if f not in STUDENT_API_FIELDS]:
+                    raise ValueError
+            date = None
+            if request.GET.get("date"):
+                date = datetime.datetime.strptime(request.GET["date"], "%Y-%m-%d").date()
+            if request.GET.get("section"):
+                students = Person.objects.section(request.GET["section"], date)
+            elif date:
+                students = Person.objects.enrolled(date)
+            else:
+                students = Person.objects.filter(kind=STUDENT_KIND)
+            if request.GET.get("cohort"):
+                students = students.filter(student_cohort=int(request.GET["cohort"]))
+            if request.GET.get("changed_since"):
+                students = students.filter(modified_at__gte=
+                    datetime.datetime.strptime(request.GET["changed_since"], "%Y-%m-%dT%H:%M:%S"))
+            after, limit = _api_paging(request)
+        except ValueError:
+            return HttpResponse("Bad students API query", status=400)
+        response = HttpResponse(closing_connection(_stream_students(students, fields, after, limit)), 
+            mimetype="application/json")
+    response["ETag"] = etag
+    response["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    return response
+
+def _classmeeting_rows(classmeetings, after, limit):
+    """API rows for classmeetings: two queries per page, one of them for instructor letters"""
+    field = ClassMeeting._meta.get_field("instructors")
+    for page in _api_pages(classmeetings, after, limit):
+        cursor = connection.cursor()
+        cursor.execute("SELECT t.%s, p.instructor_letter FROM %s t INNER JOIN %s p ON p.id = t.%s WHERE t.%s IN (%s) ORDER BY p.instructor_letter" 
+            % (field.m2m_column_name(), field.m2m_db_table(), Person._meta.db_table, field.m2m_reverse_name(), 
+            field.m2m_column_name(), ", ".join(["%s"] * len(page))), [c.id for c in page])
+        teaching = {}
+        for classmeeting_id, letter in cursor.fetchall():
+            teaching.setdefault(classmeeting_id, []).append(letter)
+        for c in page:
+            yield {'id': c.id, 'date': c.date, 'time_start': c.time_start, 'time_end': c.time_end,
+                'course_id': c.course_id, 'course_number': c.course.course_number, 
+                'course': c.course.schedule_name, 'section': c.section, 'room': unicode(c.room),
+                'session_id': c.session_id, 'hour_index': c.hour_index, 'instructors': teaching.get(c.id, [])}
+
+def _scan_rows(scans, after, limit):
+    """API rows for scans: one query per page, joined to the people"""
+    for page in _api_pages(scans, after, limit):
+        for s in page:
+            yield {'id': s.id, 'timestamp': s.timestamp, 'last_seen': s.last_seen, 'person_id': s.person_id,
+                'id_number': s.person.id_number, 'lastname': s.person.lastname, 
+                'firstname': s.person.preferred_firstname, 'classmeeting_id': s.classmeeting_id, 
+                'is_signout': s.is_signout, 'is_kiosk': s.is_kiosk, 'kiosk': s.kiosk}
+
+def _attendance_rows(classmeetings, after, limit, inclusive):
+    """
+    API rows for attendance: a row per expected or present student per class,
+    from AttendanceRecords, ATTENDANCE_API_CHUNK classes (three queries) at a time
+    """
+    for page in _api_pages(classmeetings, after, limit, size=ATTENDANCE_API_CHUNK):
+        rosters = AttendanceRecord.objects.attendance_for(page, inclusive=inclusive)
+        for c in page:
+            present, absent = rosters[c.id]
+            for status, people in (("present", present), ("absent", absent)):
+                for person in people:
+                    yield {'class_id': c.id, 'date': c.date, 'time_start': c.time_start, 
+                        'section': c.section, 'course': c.course.schedule_name, 'person_id': person.id,
+                        'id_number': person.id_number, 'lastname': person.lastname, 
+                        'firstname': person.preferred_firstname, 'status': status}
+
+@login_required
+def classmeetings_api(request):
+    """
+    Return the classmeetings in a date range, in JSON or CSV, streamed in id
+    order. GET parameters, all optional:
+
+        start, end      the dates (YYYY-MM-DD, inclusive; default today), 
+                        at most API_MAX_DAYS of them
+        after, limit    keyset paging: at most "limit" classmeetings with ids 
+                        above "after"; for the next page, pass the last id received
+        format          "csv" for CSV; JSON otherwise
+
+    Conditional GETs are answered with 304 Not Modified until the schedule for 
+    one of the dates changes.
+    """
+    try:
+        dates = _api_dates(request)
+        after, limit = _api_paging(request)
+    except ValueError:
+        return HttpResponse("Bad class meetings API query", status=400)
+    classmeetings = ClassMeeting.objects.filter(date__range=(dates[0], dates[-1])).select_related()
+    return _api_response(request, _classmeeting_rows(classmeetings, after, limit), CLASSMEETING_API_COLUMNS,
+        ["classmeetings.%s" % d for d in dates])
+
+@login_required
+def scans_api(request):
+    """
+    Return the scans (signouts included) made in a date range, in JSON or CSV,
+    streamed in id order. Takes the same parameters as classmeetings_api().
+    """
+    try:
+        dates = _api_dates(request)
+        after, limit = _api_paging(request)
+    except ValueError:
+        return HttpResponse("Bad scans API query", status=400)
+    scans = Scan.admin_objects.filter(timestamp__gte=start_of_day(dates[0]), 
+        timestamp__lt=start_of_day(dates[-1] + datetime.timedelta(days=1))).select_related()
+    return _api_response(request, _scan_rows(scans, after, limit), SCAN_API_COLUMNS,
+        ["people"] + ["scans.%s" % d for d in dates])
+
+@login_required
+def attendance_api(request):
+    """
+    Return attendance for the classmeetings in a date range, in JSON or CSV: a 
+    row for each student expected in or present at each class hour, with a 
+    status of "present" or "absent". Takes the same parameters as 
+    classmeetings_api(), with "after" and "limit" counting classmeetings, and
+    also "inclusive" (1 to count students whose ID expires on the day, as the
+    attendance reports do).
+    """
+    try:
+        dates = _api_dates(request)
+        after, limit = _api_paging(request)
+    except ValueError:
+        return HttpResponse("Bad attendance API query", status=400)
+    classmeetings = ClassMeeting.objects.filter(date__range=(dates[0], dates[-1])).select_related()
+    rows = _attendance_rows(classmeetings, after, limit, bool(request.GET.get("inclusive")))
+    return _api_response(request, rows, ATTENDANCE_API_COLUMNS,
+        ["people", "phases"] + ["classmeetings.%s" % d for d in dates] + ["scans.%s" % d for d in dates])
@@ -15,6 +15,16 @@ SECRET_KEY = 'notverysecret'
 ROOT_URLCONF = 'urls'
 TEMPLATE_DIRS = []
 
+# The cache must be shared by every server process and utility script, so that
+# a version bump (see infobase.models.cache_versions) reaches them all; with the
+# default process-local cache, other processes would go on serving stale data.
+# memcached ('memcached://127.0.0.1:11211/') also works, if it's installed.
+# The file cache culls a third of its entries once it holds max_entries; 
+# there is one attendance entry per class and one student report per student
+# per day, so this leaves room for a couple of phases of those. An evicted
+# version stamp just starts a fresh version, so culling never serves stale data.
+CACHE_BACKEND = 'file:///var/tmp/school-base_cache?max_entries=20000&cull_frequency=3'
+
 TEMPLATE_LOADERS = (
     'django.template.loaders.app_directories.load_template_source',
     'django.template.loaders.filesystem.load_template_source',
@@ -5,6 +5,7 @@ from infobase.models import Person
 
 # Attendance system
 urlpatterns = patterns("infobase.views",
+    (r"^scan/batch/$", "scan_batch"),
     (r"^scan/", "scan"),
     (r"^attendance/$", "attendance"),
     (r"^attendance/(?P<class_id>\d+)/$", "attendance"),
@@ -12,6 +13,7 @@ urlpatterns = patterns("infobase.views",
     (r"^report/$", "report"),
     (r"^report/student/(?P<student_id>\d+)?/?$", "student_report"),
     (r"^report/noshow/$", "noshow"),
+    (r"^report/noshow/(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/$", "noshow"),
     (r"^report/(?P<class_id>\d+)/$", "report"),
     (r"^report/(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/$", "report"),
     (r"^report/whereis/(?P<person_id>\d{7})/$", "report"),
@@ -20,6 +22,9 @@ urlpatterns = patterns("infobase.views",
     (r"^schedule/$", "schedule"),
     (r"^flagged/(?:(?P<flag_name>.+)/)?$", "flagged_people"),
     (r"^api/students/", "students_api"),
+    (r"^api/classmeetings/$", "classmeetings_api"),
+    (r"^api/scans/$", "scans_api"),
+    (r"^api/attendance/$", "attendance_api"),
     (r"^admin/infobase/phonelist/$", "phone_list"),
     (r"^admin/scheduler/(?:(?P<datestring>.+)/)?$", "schedule_builder"),
     )
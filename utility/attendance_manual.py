@@ -11,15 +11,15 @@ from optparse import OptionParser, OptParseError
 os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
 from django.core.mail import send_mail
 from django.conf import settings
-from infobase.models import Scan, Person, ClassMeeting, SECTIONS
+from infobase.models import AttendanceRecord, Scan, Person, ClassMeeting, SECTIONS
 
 
-def classmeeting_report_markdown(c):
+def classmeeting_report_markdown(c, rosters):
     output = "\n%s\n### %s\n" % ("-"*80, c.report_header())
     if c.instructors.count():
         output += "#### Instructors: %s\n" % c.instructor_list()
     output += "\n"
-    present, absent = c.attendance()
+    present, absent = rosters[c.id]
     if present:
         output += "**PRESENT (%s)**" % len(present) + "\n"
         output += ", ".join(unicode(p) for p in present) + "\n\n"
@@ -29,14 +29,18 @@ def classmeeting_report_markdown(c):
     return output
 
 
-def classmeeting_report_csv(c):
+def classmeeting_report_csv(c, rosters, expected):
+    """
+    CSV lines for one class; `rosters` and `expected` come from the
+    AttendanceRecord.objects.attendance_for() and ClassMeeting.objects.expected_for() 
+    bulk methods.
+    """
     output = ""
-    expected = Person.objects.section(c.section, c.date, inclusive=True)
-    present_raw = sorted(s.person for s in c.scan_set.all())
+    present_ids = set(p.id for p in rosters[c.id][0])
     classinfo = '"%s","%s","%s",%s,%s,%s' % (c.course.course_number, c.course.schedule_name, c.date, "%d:%02d" % (c.time_start.hour, c.time_start.minute), c.section, c.number_of_hours())
-    for student in expected:
+    for student in expected[c.id]:
         output += '%s,"%s","%s","%s",' % (classinfo, student.id_number, student.lastname, student.firstname)
-        if student in present_raw:
+        if student.id in present_ids:
             output += "present"
         else:
             output += "absent"
@@ -127,11 +131,16 @@ if __name__ == "__main__":
         sys.exit()
         
     classes = prep_classmeeting_list(classes)
+    if options.csv_flag:
+        rosters = AttendanceRecord.objects.attendance_for(classes, inclusive=True)
+        expected = ClassMeeting.objects.expected_for(classes, inclusive=True)
+    else:
+        rosters = AttendanceRecord.objects.attendance_for(classes)
     for c in classes:
         if options.csv_flag:
-            output += classmeeting_report_csv(c).encode("latin-1")
+            output += classmeeting_report_csv(c, rosters, expected).encode("latin-1")
         elif options.markdown_flag:
-            output += classmeeting_report_markdown(c).encode("latin-1")
+            output += classmeeting_report_markdown(c, rosters).encode("latin-1")
     if options.mail_to:
         recipients = options.mail_to.split(",") + [email for name, email in settings.MANAGERS]
         send_mail(header, output, settings.DEFAULT_FROM_EMAIL, recipients)
@@ -13,6 +13,7 @@ from optparse import OptionParser
 os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
 from django.core.mail import send_mail
 from django.conf import settings
+from django.db.models import Q
 from infobase.models import Course, ClassMeeting, Scan, Person, SECTIONS, STUDENT_KIND
 
 
@@ -127,6 +128,15 @@ def last_scan_for_person(scan_set, person):
     return scans_found[-1]
 
 
+def scanned_during(span):
+    """
+    Filter for scans in the given Timespan. Repeat scans collapsed into an 
+    earlier one (see Scan.from_kiosk) count by their last_seen time.
+    """
+    return (Q(timestamp__gte=span.begin, timestamp__lte=span.end) 
+        | Q(last_seen__gte=span.begin, last_seen__lte=span.end))
+
+
 def scan_breakdown(block, options):
     scans = Scan.barcode_scans_for_date(date)
     students = Person.objects.enrolled(date, inclusive=True)
@@ -134,9 +144,9 @@ def scan_breakdown(block, options):
         students = [s for s in students if s.section() in options.sections]
     student_pks = set(p.id for p in students)
 
-    scans_in = scans.filter(timestamp__gte=block.startspan.begin, timestamp__lte=block.startspan.end)
+    scans_in = scans.filter(scanned_during(block.startspan))
     people_scanned_in = set(s.person.id for s in scans_in)
-    scans_out = scans.filter(timestamp__gte=block.endspan.begin, timestamp__lte=block.endspan.end)
+    scans_out = scans.filter(scanned_during(block.endspan))
     people_scanned_out = set(s.person.id for s in scans_out)
     present_people_pks = people_scanned_out & people_scanned_in
     present_people = Person.objects.enrolled(date, inclusive=True).filter(pk__in=list(present_people_pks))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Fill in (or check) the contiguous-hours session index on ClassMeetings.
+
+ClassMeeting.save() and delete() keep the index current, so this is only needed
+once, after adding the columns to an existing database:
+
+    ALTER TABLE infobase_classmeeting ADD COLUMN session_id integer NULL;
+    ALTER TABLE infobase_classmeeting ADD COLUMN hour_index smallint NULL;
+    CREATE INDEX infobase_classmeeting_session_id ON infobase_classmeeting (session_id);
+
+or after schedule data has been changed behind the ORM's back.
+"""
+
+import datetime
+import os
+import sys
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from infobase.models import ClassMeeting
+
+
+def backfill(classmeetings, commit=True):
+    """
+    Reindex the given classmeetings a day at a time, so that memory use stays modest.
+    Return the number of rows that were (or without commit, would be) changed.
+    """
+    dates = sorted(set(c['date'] for c in classmeetings.values('date').distinct() if c['date']))
+    changed = 0
+    for date in dates:
+        meetings = list(ClassMeeting.objects.filter(date=date))
+        before = dict((c.id, (c.session_id, c.hour_index)) for c in meetings)
+        ClassMeeting.objects.reindex_sessions(meetings, commit=commit)
+        changed += len([c for c in meetings if before[c.id] != (c.session_id, c.hour_index)])
+    return changed
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="Fill in the session index for ClassMeetings.")
+    parser.add_option("-s", "--start",
+        help="First date to index, YYYY-MM-DD (default: the beginning)")
+    parser.add_option("-e", "--end",
+        help="Last date to index, YYYY-MM-DD (default: the end)")
+    parser.add_option("-x", "--check",
+        action="store_true",
+        help="Only report how many rows are out of date; change nothing")
+    (options, args) = parser.parse_args()
+
+    classmeetings = ClassMeeting.objects.all()
+    try:
+        if options.start:
+            classmeetings = classmeetings.filter(date__gte=datetime.datetime.strptime(options.start, "%Y-%m-%d").date())
+        if options.end:
+            classmeetings = classmeetings.filter(date__lte=datetime.datetime.strptime(options.end, "%Y-%m-%d").date())
+    except ValueError:
+        parser.print_help()
+        sys.exit()
+
+    changed = backfill(classmeetings, commit=not options.check)
+    if options.check:
+        print "%d classmeetings need reindexing" % changed
+    else:
+        print "Reindexed %d classmeetings" % changed
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Check Person.last_scan_at against the Scan table, reporting (and, unless --check
+is given, correcting) anyone whose stored value is wrong.
+
+Scan saves and deletes keep last_scan_at current, so this is for after bulk
+changes made outside the ORM, or to fill in the column when it is first added.
+"""
+
+import os
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from infobase.models import Person
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [--check]")
+    parser.add_option("-x", "--check",
+        action="store_true",
+        help="Only compare stored values with the Scan table; change nothing")
+    (options, args) = parser.parse_args()
+
+    mismatches = Person.objects.rebuild_last_scan(commit=not options.check)
+    for person_id, stored, recomputed in mismatches:
+        print "%s: stored %s, live %s" % (Person.objects.get(id=person_id), stored, recomputed)
+    if options.check:
+        print "%d people have a stale last scan time" % len(mismatches)
+    else:
+        print "Corrected %d last scan times" % len(mismatches)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Collapse runs of repeat barcode scans (a student scanning two or three times in a
+row) recorded before the kiosk started debouncing them.
+
+Within each run -- scans by the same person at the same kiosk, for the same class,
+no more than the debounce window after the run's first scan -- the first and last
+scans are kept, since the scanned-attendance windows depend on them. The scans in
+between are deleted and counted in the first scan's repeat_count, and their kiosk
+keys move to the first scan (as ScanKeys), so resubmitting them stays harmless.
+The scans are deleted in bulk, so the attendance records, last_scan_at times and
+cache versions that Scan.delete() would keep current are refreshed afterwards.
+"""
+
+import datetime
+import os
+import sys
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from django.conf import settings
+from django.db import transaction
+from infobase.models import AttendanceRecord, Person, Scan, ScanKey, bump_cache_version
+
+
+def repeat_runs(scans, window):
+    """
+    Split scans (all by one person, at one kiosk, for one class) into runs of
+    repeats, each a list in timestamp order.
+    """
+    runs = []
+    for scan in sorted(scans, key=lambda s: s.timestamp):
+        if runs and scan.timestamp - runs[-1][0].timestamp <= window:
+            runs[-1].append(scan)
+        else:
+            runs.append([scan])
+    return runs
+
+
+def compact_day(date, window, commit=True):
+    """Compact one day's barcode scans; return the number of scans removed."""
+    next_day = date + datetime.timedelta(1)
+    scans = Scan.objects.filter(timestamp__gte=date, timestamp__lt=next_day).extra(
+        where=["(classmeeting_id is NULL OR is_kiosk)"])
+    groups = {}
+    for scan in scans:
+        groups.setdefault((scan.person_id, scan.kiosk, scan.classmeeting_id), []).append(scan)
+    doomed = []
+    moved_keys = []
+    affected = set()
+    for group in groups.values():
+        for run in repeat_runs(group, window):
+            middle = run[1:-1]
+            if not middle:
+                continue
+            first = run[0]
+            first.repeat_count += sum(s.repeat_count + 1 for s in middle)
+            if commit:
+                first.save()
+                for collapsed in ScanKey.objects.filter(scan__in=[s.id for s in middle]):
+                    collapsed.scan = first
+                    collapsed.save()
+            moved_keys.extend((s.client_key, first) for s in middle if s.client_key)
+            doomed.extend(s.id for s in middle)
+            affected.add((first.classmeeting_id, first.person_id))
+    if doomed and commit:
+        Scan.admin_objects.filter(id__in=doomed).delete()
+        for client_key, scan in moved_keys:
+            ScanKey.objects.create(client_key=client_key, scan=scan)
+        for classmeeting_id, person_id in affected:
+            if classmeeting_id:
+                AttendanceRecord.refresh(classmeeting_id, person_id)
+        person_ids = set(person_id for classmeeting_id, person_id in affected)
+        Person.objects.refresh_last_scan(person_ids)
+        bump_cache_version("scans.%s" % date)
+        for person_id in person_ids:
+            bump_cache_version("person.%s" % person_id)
+    return len(doomed)
+compact_day = transaction.commit_on_success(compact_day)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog --start YYYY-MM-DD [--end YYYY-MM-DD] [--check]")
+    parser.add_option("-s", "--start",
+        help="First date to compact")
+    parser.add_option("-e", "--end",
+        help="Last date to compact (default: same as start)")
+    parser.add_option("-w", "--window",
+        type="int", default=getattr(settings, "SCAN_DEBOUNCE_SECONDS", 120),
+        help="Repeat-scan window in seconds (default: settings.SCAN_DEBOUNCE_SECONDS, or 120)")
+    parser.add_option("-x", "--check",
+        action="store_true",
+        help="Only count the scans that would be removed")
+    (options, args) = parser.parse_args()
+
+    try:
+        start = datetime.datetime.strptime(options.start, "%Y-%m-%d").date()
+        end = datetime.datetime.strptime(options.end or options.start, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        parser.print_help()
+        sys.exit()
+
+    window = datetime.timedelta(seconds=options.window)
+    removed = 0
+    date = start
+    while date <= end:
+        removed += compact_day(date, window, commit=not options.check)
+        date += datetime.timedelta(days=1)
+    if options.check:
+        print "%d repeat scans would be removed" % removed
+    else:
+        print "Removed %d repeat scans" % removed
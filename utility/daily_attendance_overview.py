@@ -18,9 +18,10 @@ from django.conf import settings
 from infobase.models import ClassMeeting
 
 
-def classmeeting_summary(classmeeting):
+def classmeeting_summary(classmeeting, rosters):
+    """One line of the summary; `rosters` comes from ClassMeeting.objects.attendance_for()"""
     vitals = "%s (%s) %s" % (classmeeting.course, classmeeting.section, classmeeting.time_start)
-    present, absent = classmeeting.attendance()
+    present, absent = rosters[classmeeting.id]
     if present:
         output = "%s/%s -- %s" % (len(present), len(absent), vitals)
     elif classmeeting.is_all_school():
@@ -44,6 +45,7 @@ def summarize(classmeetings):
     Headers for each day are ready for multi-day reports.
     """
     classmeetings = sorted(classmeetings, cmp=meeting_cmp)
+    rosters = ClassMeeting.objects.attendance_for(classmeetings)
     output = "# Attendance Summary\n\n"
     working_date = None
     class_count = 0
@@ -52,7 +54,7 @@ def summarize(classmeetings):
             output += "## %s\n\n" % meeting.date
             working_date = meeting.date
         if not meeting.is_open() and meeting.has_started() and meeting.is_first_hour():
-            output += classmeeting_summary(meeting) + "  \n"
+            output += classmeeting_summary(meeting, rosters) + "  \n"
             class_count += 1
     if class_count:
         return output
@@ -10,8 +10,7 @@ import optparse
 import os
 import sys
 os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
-from django.db.models import Q
-from equipment.models import Item, ItemType
+from equipment.models import Item, ItemType, ITEM_NUMBER_INDEX
 
 
 def read_data(options):
@@ -32,9 +31,9 @@ def check_data(number_list, options):
     trouble = False
     std_num_len = len(number_list[0])
     for number in number_list:
-        dupes = Item.objects.filter(Q(hip_number=number)|Q(serialnumber=number)).count()
+        dupes = ITEM_NUMBER_INDEX.item_ids(number)
         if dupes:
-            print "Number %s already present: %s" % (number, Item.find_by_number(number))
+            print "Number %s already present: %s" % (number, ", ".join([str(Item.objects.get(id=i)) for i in dupes]))
             trouble = True
         if len(number) != std_num_len:
             print "Number %s is different length (%s instead of %s)" % (number, len(number), std_num_len)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Make small copies of the ID photos in MEDIA_ROOT/faces for the facesheet and
+other pages that show many people, and write the photo manifest that
+Person.id_thumbnail_url() reads (see PhotoManifest).
+
+Only photos that are new or changed since the last run are resized. Thumbnail
+file names include a hash of their contents, so the web server can send them
+with far-future expiry headers. Thumbnails of photos that have been removed or
+replaced are deleted. Run it after importing new photos.
+
+Requires the Python Imaging Library.
+"""
+
+import md5
+import os
+import sys
+from cStringIO import StringIO
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from django.conf import settings
+from django.utils import simplejson
+from infobase.models import PhotoManifest
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+
+def make_thumbnail(path, size, quality):
+    """JPEG data for a copy of the image at path that fits in size x size pixels"""
+    image = Image.open(path)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((size, size), Image.ANTIALIAS)
+    data = StringIO()
+    image.save(data, "JPEG", quality=quality, optimize=True)
+    return data.getvalue()
+
+
+def update_manifest(manifest, size, quality, force=False):
+    """
+    Bring manifest ({id number: {"file", "mtime", "thumbnail"}}) up to date with
+    the faces directory, writing thumbnails as needed. Return (made, removed).
+    """
+    faces_dir = os.path.join(settings.MEDIA_ROOT, PhotoManifest.FACES)
+    thumbs_dir = os.path.join(settings.MEDIA_ROOT, PhotoManifest.THUMBS)
+    if not os.path.isdir(thumbs_dir):
+        os.makedirs(thumbs_dir)
+    made = removed = 0
+    seen = set()
+    for name in sorted(os.listdir(faces_dir)):
+        id_number, ext = os.path.splitext(name)
+        if ext != ".jpg" or name == os.path.basename(PhotoManifest.NO_PHOTO):
+            continue
+        seen.add(id_number)
+        path = os.path.join(faces_dir, name)
+        mtime = int(os.stat(path).st_mtime)
+        entry = manifest.get(id_number)
+        if (not force and entry and entry["mtime"] == mtime
+            and os.path.exists(os.path.join(settings.MEDIA_ROOT, entry["thumbnail"]))):
+            continue
+        try:
+            data = make_thumbnail(path, size, quality)
+        except IOError, e:
+            print "Skipping %s: %s" % (name, e)
+            continue
+        thumbnail = "%s/%s-%s.jpg" % (PhotoManifest.THUMBS, id_number, md5.new(data).hexdigest()[:12])
+        if not os.path.exists(os.path.join(settings.MEDIA_ROOT, thumbnail)):
+            open(os.path.join(settings.MEDIA_ROOT, thumbnail), "wb").write(data)
+        if entry and entry["thumbnail"] != thumbnail:
+            remove_thumbnail(entry["thumbnail"])
+        manifest[id_number] = {'file': "%s/%s" % (PhotoManifest.FACES, name),
+            'mtime': mtime, 'thumbnail': thumbnail}
+        made += 1
+    for id_number in set(manifest) - seen:
+        remove_thumbnail(manifest.pop(id_number)["thumbnail"])
+        removed += 1
+    return made, removed
+
+
+def remove_thumbnail(thumbnail):
+    try:
+        os.remove(os.path.join(settings.MEDIA_ROOT, thumbnail))
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [--size N] [--force]")
+    parser.add_option("-s", "--size",
+        type="int", default=100,
+        help="Largest width or height of a thumbnail, in pixels (default 100, as on the facesheet)")
+    parser.add_option("-q", "--quality",
+        type="int", default=80,
+        help="JPEG quality of the thumbnails (default 80)")
+    parser.add_option("-f", "--force",
+        action="store_true",
+        help="Remake every thumbnail, e.g. after changing --size")
+    (options, args) = parser.parse_args()
+
+    if Image is None:
+        print "The Python Imaging Library (PIL) is needed to make thumbnails."
+        sys.exit(1)
+    manifest_path = os.path.join(settings.MEDIA_ROOT, PhotoManifest.MANIFEST)
+    try:
+        manifest = simplejson.load(open(manifest_path))
+    except (IOError, ValueError):
+        manifest = {}
+    made, removed = update_manifest(manifest, options.size, options.quality, options.force)
+    # Replace the manifest in one step, so the web server never reads half of it
+    temp_path = manifest_path + ".new"
+    simplejson.dump(manifest, open(temp_path, "w"), indent=1, sort_keys=True)
+    os.rename(temp_path, manifest_path)
+    print "%d thumbnails made, %d removed, %d photos in manifest" % (made, removed, len(manifest))
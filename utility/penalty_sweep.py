@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+Levy late-equipment penalties on every student with overdue equipment, as
+penalty_statement does for one student at a time (see PenaltyManager.sweep).
+
+Meant to run nightly from cron. Items a student has already been penalized
+for (by an earlier run, or by hand) since they fell due are not charged again,
+so each late item is charged once, however many nights it stays out.
+"""
+
+import os
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from equipment.models import Penalty
+from infobase.models import Person
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [--check]")
+    parser.add_option("-x", "--check", "--dry-run",
+        action="store_true",
+        help="Only list the penalties that would be levied; change nothing")
+    (options, args) = parser.parse_args()
+
+    levies = Penalty.objects.sweep(commit=not options.check)
+    students = Person.objects.in_bulk([student_id for student_id, amount, item_ids in levies])
+    for student_id, amount, item_ids in levies:
+        print "%s: $%s for %d item(s)" % (students[student_id], amount, len(item_ids))
+    if options.check:
+        print "%d penalties would be levied" % len(levies)
+    else:
+        print "Levied %d penalties" % len(levies)
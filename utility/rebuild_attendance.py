@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Recompute AttendanceRecords for a range of dates from the Scan table, reporting
+any students the records showed differently from the live calculation 
+(ClassMeeting.objects.attendance_for(), which reads the scans directly).
+
+Scan saves and deletes keep the records current, so normally this is only run
+with --check, or to fill in the table for dates before it existed.
+"""
+
+import datetime
+import os
+import sys
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from infobase.models import AttendanceRecord, ClassMeeting, Person
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog --start YYYY-MM-DD [--end YYYY-MM-DD] [--check]")
+    parser.add_option("-s", "--start",
+        help="First date to rebuild")
+    parser.add_option("-e", "--end",
+        help="Last date to rebuild (default: same as start)")
+    parser.add_option("-x", "--check",
+        action="store_true",
+        help="Only compare stored records with the live calculation; change nothing")
+    (options, args) = parser.parse_args()
+
+    try:
+        start = datetime.datetime.strptime(options.start, "%Y-%m-%d").date()
+        end = datetime.datetime.strptime(options.end or options.start, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        parser.print_help()
+        sys.exit()
+
+    status_names = dict(AttendanceRecord.STATUS_CHOICES)
+    date = start
+    total_mismatches = 0
+    while date <= end:
+        classmeetings = ClassMeeting.objects.filter(date=date)
+        mismatches = AttendanceRecord.rebuild(classmeetings, commit=not options.check)
+        for classmeeting_id, person_id, stored, live in mismatches:
+            print "%s: %s, %s: stored %s, live %s" % (date, ClassMeeting.objects.get(id=classmeeting_id), 
+                Person.objects.get(id=person_id), status_names[stored], status_names[live])
+        total_mismatches += len(mismatches)
+        date += datetime.timedelta(days=1)
+    if options.check:
+        print "%d records differ from the live calculation" % total_mismatches
+    else:
+        print "Rebuilt records for %s to %s (%d corrected)" % (start, end, total_mismatches)
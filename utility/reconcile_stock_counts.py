@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""
+Check the stock counters on each equipment ItemType against the items
+themselves, reporting (and, unless --check is given, correcting) any that are
+wrong.
+
+Item saves and deletes and kit check-in/out keep the counters current, so this
+is for after changes made outside the ORM, or to fill in the counters when
+they are first added.
+"""
+
+import os
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from equipment.models import ItemType
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [--check]")
+    parser.add_option("-x", "--check",
+        action="store_true",
+        help="Only compare stored counts with the items; change nothing")
+    (options, args) = parser.parse_args()
+
+    mismatches = ItemType.objects.recount(commit=not options.check)
+    for itemtype, counter, stored, actual in mismatches:
+        print "%s: %s stored %s, actual %s" % (itemtype, counter, stored, actual)
+    if options.check:
+        print "%d stock counters are wrong" % len(mismatches)
+    else:
+        print "Corrected %d stock counters" % len(mismatches)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Status feed server: pushes changes to the status dashboard as they happen.
+
+Dashboards are left open all day, and each one waiting on the web server would
+tie up a Django worker, so this is a separate single-threaded process that holds
+every client's connection open at once (asyncore). Once a second it reads new
+StatusChange entries, which scan and class saves write, and turns them into
+deltas for all its clients. It also notices when a section moves on to its next
+class.
+
+Each delta is a JSON object with a "type" of:
+    scan     someone scanned: section, class_id, person, time, change_id
+    counts   a class's attendance changed: section, class_id, present, absent,
+             absentees
+    class    a section is in a different class, or its class was edited:
+             section, class_id (null if none), course, room, time_start,
+             instructors
+
+Clients long-poll
+    GET /feed/status/?since=N    ->  {"last": M, "events": [...]}
+which is answered as soon as there are deltas after N, or with none after
+POLL_TIMEOUT seconds. Without "since" it answers at once with the current
+"last". If the server no longer has N (after a restart, say) the answer is
+{"reset": true} and the client should reload the page. Clients can also read
+server-sent events from
+    GET /feed/status/stream/?since=N
+Only requests carrying a logged-in Django session cookie are served.
+
+Run it behind Apache, under the same host name as the site, so that the session
+cookie reaches it; utility/status_feed.conf is the proxy configuration to include
+in the site's virtual host.
+utility/status_feed_harness.py exercises it with simulated clients.
+"""
+
+import asynchat
+import asyncore
+import cgi
+import datetime
+import os
+import socket
+import sys
+import time
+import traceback
+import urlparse
+import Cookie
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.utils import simplejson
+from django.utils.dateformat import time_format
+from infobase.models import ClassMeeting, StatusChange, SCHEDULE_INDEX, SECTIONS
+
+POLL_INTERVAL = 1           # seconds between journal reads
+POLL_TIMEOUT = 25           # seconds a long-poll is held open with nothing to send
+HEARTBEAT_INTERVAL = 15     # seconds between keep-alive comments on event streams
+SESSION_RECHECK = 300       # seconds a session cookie is trusted before checking it again
+PRUNE_INTERVAL = 60 * 60    # seconds between prunings of the journal
+BACKLOG = 1000              # deltas kept for clients that are catching up
+MAX_REQUEST = 8192          # bytes of request headers accepted
+
+STATUS_LINES = {200: "200 OK", 400: "400 Bad Request", 403: "403 Forbidden", 404: "404 Not Found"}
+
+
+def class_delta(section, theclass):
+    if not theclass:
+        return {'type': "class", 'section': section, 'class_id': None}
+    return {'type': "class", 'section': section, 'class_id': theclass.id,
+        'course': theclass.course.schedule_name, 'room': unicode(theclass.room),
+        'time_start': time_format(theclass.time_start, "P"), 'instructors': theclass.instructor_list()}
+
+
+def counts_delta(theclass, present, absent):
+    return {'type': "counts", 'section': theclass.section, 'class_id': theclass.id,
+        'present': len(present), 'absent': len(absent), 'absentees': [unicode(p) for p in absent]}
+
+
+def scan_delta(change):
+    return {'type': "scan", 'section': change.section, 'class_id': change.classmeeting_id,
+        'person': change.person_id and unicode(change.person) or "",
+        'time': time_format(change.timestamp.time(), "P"), 'change_id': change.id}
+
+
+class Feed(object):
+    """The numbered deltas sent so far, and the clients waiting for more"""
+
+    def __init__(self, check_sessions=True):
+        self.check_sessions = check_sessions
+        self.deltas = []        # (number, JSON text), oldest first
+        self.last = 0
+        self.waiting = []       # long-poll clients
+        self.streams = []       # event-stream clients
+        self.sessions = {}      # session key: time to check it again
+        self.next_heartbeat = time.time() + HEARTBEAT_INTERVAL
+        self.next_prune = 0
+        try:
+            self.last_change = StatusChange.objects.order_by("-id")[0].id
+        except IndexError:
+            self.last_change = 0
+        now = datetime.datetime.now()
+        self.classes = dict((s, SCHEDULE_INDEX.section_class(s, now)) for s in SECTIONS)
+        transaction.commit_unless_managed()
+
+    def add(self, delta):
+        self.last += 1
+        self.deltas.append((self.last, simplejson.dumps(delta)))
+        del self.deltas[:-BACKLOG]
+
+    def after(self, number):
+        """Deltas after the given number, or None if the server can't say"""
+        if number > self.last or (self.deltas and number < self.deltas[0][0] - 1):
+            return None
+        return [(n, delta) for n, delta in self.deltas if n > number]
+
+    def poll(self):
+        """Turn new journal entries and class changes into deltas, and send them"""
+        first_new = self.last + 1
+        changes = list(StatusChange.objects.since(self.last_change))
+        touched = set()
+        edited_sections = set()
+        for change in changes:
+            self.last_change = change.id
+            if change.kind == StatusChange.SCAN:
+                self.add(scan_delta(change))
+                if change.classmeeting_id:
+                    touched.add(change.classmeeting_id)
+            else:
+                edited_sections.add(change.section)
+        if edited_sections:
+            SCHEDULE_INDEX.invalidate(datetime.date.today())
+        now = datetime.datetime.now()
+        for section in SECTIONS:
+            theclass = SCHEDULE_INDEX.section_class(section, now)
+            class_id = theclass and theclass.id
+            if class_id != (self.classes[section] and self.classes[section].id) or section in edited_sections:
+                self.classes[section] = theclass
+                self.add(class_delta(section, theclass))
+                if theclass:
+                    touched.add(theclass.id)
+        current = [c for c in self.classes.values() if c and c.id in touched]
+        if current:
+            rosters = ClassMeeting.objects.attendance_for(current)
+            for theclass in current:
+                self.add(counts_delta(theclass, *rosters[theclass.id]))
+        if time.time() > self.next_prune:
+            StatusChange.prune()
+            self.next_prune = time.time() + PRUNE_INTERVAL
+        transaction.commit_unless_managed()  # so the next poll sees newly committed rows
+        self.notify([(n, delta) for n, delta in self.deltas if n >= first_new])
+
+    def notify(self, new):
+        """Answer waiting long-polls that have news or have timed out, and feed the streams"""
+        now = time.time()
+        for client in self.waiting[:]:
+            if new or client.deadline < now:
+                self.waiting.remove(client)
+                client.send_deltas(self.last, new)
+        heartbeat = now > self.next_heartbeat
+        if heartbeat:
+            self.next_heartbeat = now + HEARTBEAT_INTERVAL
+        for client in self.streams:
+            if new:
+                client.send_events(new)
+            elif heartbeat:
+                client.push(": keep-alive\n\n")
+
+    def authorized(self, cookie_header):
+        """Does this Cookie header carry the session of a logged-in user?"""
+        if not self.check_sessions:
+            return True
+        try:
+            key = Cookie.SimpleCookie(cookie_header)[settings.SESSION_COOKIE_NAME].value
+        except (Cookie.CookieError, KeyError):
+            return False
+        if self.sessions.get(key, 0) > time.time():
+            return True
+        try:
+            session = Session.objects.get(session_key=key, expire_date__gt=datetime.datetime.now())
+            logged_in = "_auth_user_id" in session.get_decoded()
+        except Session.DoesNotExist:
+            logged_in = False
+        transaction.commit_unless_managed()
+        if logged_in:
+            self.sessions[key] = time.time() + SESSION_RECHECK
+        return logged_in
+
+    def long_poll(self, client, since):
+        if since is None:
+            return client.send_deltas(self.last, [])
+        new = self.after(since)
+        if new is None:
+            client.respond(200, simplejson.dumps({'reset': True, 'last': self.last}))
+        elif new:
+            client.send_deltas(self.last, new)
+        else:
+            client.deadline = time.time() + POLL_TIMEOUT
+            self.waiting.append(client)
+
+    def stream(self, client, since):
+        client.push("HTTP/1.0 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n")
+        new = []
+        if since is not None:
+            new = self.after(since)
+        if new is None:
+            client.push("event: reset\ndata: {}\n\n")
+            client.close_when_done()
+            return
+        client.send_events(new)
+        self.streams.append(client)
+
+    def drop(self, client):
+        for clients in (self.waiting, self.streams):
+            if client in clients:
+                clients.remove(client)
+
+
+class FeedClient(asynchat.async_chat):
+    """One HTTP connection: a long-poll request or an event stream"""
+
+    def __init__(self, feed, sock):
+        asynchat.async_chat.__init__(self, sock)
+        self.feed = feed
+        self.request = []
+        self.request_size = 0
+        self.deadline = None
+        self.set_terminator("\r\n\r\n")
+
+    def collect_incoming_data(self, data):
+        self.request.append(data)
+        self.request_size += len(data)
+        if self.request_size > MAX_REQUEST:
+            self.respond(400, "Request too large")
+
+    def found_terminator(self):
+        self.set_terminator(None)   # ignore anything after the headers
+        lines = "".join(self.request).split("\r\n")
+        try:
+            method, path, version = lines[0].split()
+        except ValueError:
+            return self.respond(400, "Bad request")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if not self.feed.authorized(headers.get("cookie", "")):
+            return self.respond(403, "Not logged in")
+        scheme, host, path, params, query, fragment = urlparse.urlparse(path)
+        since = cgi.parse_qs(query).get("since", [headers.get("last-event-id")])[0]
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return self.respond(400, "Bad 'since' value")
+        if path == "/feed/status/":
+            self.feed.long_poll(self, since)
+        elif path == "/feed/status/stream/":
+            self.feed.stream(self, since)
+        else:
+            self.respond(404, "Not found")
+
+    def respond(self, status, body, content_type="text/plain"):
+        self.push("HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nCache-Control: no-cache\r\n\r\n%s"
+            % (STATUS_LINES[status], content_type, len(body), body))
+        self.close_when_done()
+
+    def send_deltas(self, last, deltas):
+        """Answer a long-poll"""
+        self.respond(200, '{"last": %d, "events": [%s]}' % (last, ", ".join([d for n, d in deltas])),
+            content_type="application/json")
+
+    def send_events(self, deltas):
+        """Write deltas to an event stream"""
+        for number, delta in deltas:
+            self.push("id: %d\ndata: %s\n\n" % (number, delta))
+
+    def handle_close(self):
+        self.feed.drop(self)
+        self.close()
+
+
+class FeedServer(asyncore.dispatcher):
+    def __init__(self, feed, port):
+        asyncore.dispatcher.__init__(self)
+        self.feed = feed
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(("", port))
+        self.listen(128)
+
+    def handle_accept(self):
+        accepted = self.accept()
+        if accepted:
+            FeedClient(self.feed, accepted[0])
+
+
+def serve(port, check_sessions=True):
+    feed = Feed(check_sessions)
+    FeedServer(feed, port)
+    next_poll = time.time() + POLL_INTERVAL
+    while True:
+        asyncore.loop(timeout=POLL_INTERVAL, use_poll=True, count=1)
+        if time.time() >= next_poll:
+            try:
+                feed.poll()
+            except Exception:
+                # Keep serving through database hiccups; the next poll retries
+                traceback.print_exc()
+                transaction.rollback_unless_managed()
+            next_poll = time.time() + POLL_INTERVAL
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [--port N] [--no-auth]")
+    parser.add_option("-p", "--port",
+        type="int", default=8081,
+        help="Port to listen on (default 8081)")
+    parser.add_option("-n", "--no-auth",
+        action="store_true",
+        help="Serve requests without a logged-in session (for local testing only)")
+    (options, args) = parser.parse_args()
+
+    print "Status feed listening on port %d" % options.port
+    try:
+        serve(options.port, check_sessions=not options.no_auth)
+    except KeyboardInterrupt:
+        sys.exit()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Simulated dashboards for checking the status feed server (utility/status_feed.py).
+
+Opens --clients connections to a running feed server, all long-polling (or, with
+--stream, reading event streams). With --inject it also journals synthetic scans
+every --interval seconds. At the end it reports how many deltas each client got,
+how long the injected scans took to reach the clients, and any errors.
+
+For example, against a local server started with --no-auth:
+    ./status_feed.py --port 8081 --no-auth &
+    ./status_feed_harness.py --clients 500 --inject 20 --interval 0.5
+"""
+
+import asynchat
+import asyncore
+import os
+import socket
+import time
+from optparse import OptionParser
+os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
+from django.conf import settings
+from django.utils import simplejson
+from infobase.models import StatusChange
+
+
+class SimulatedClient(asynchat.async_chat):
+    """One dashboard: repeats long-polls, or holds an event stream open"""
+
+    def __init__(self, harness, stream=False):
+        asynchat.async_chat.__init__(self)
+        self.harness = harness
+        self.stream = stream
+        self.since = None
+        self.received = 0
+        self.errors = 0
+        self.connect_to_feed()
+
+    def connect_to_feed(self):
+        self.discard_buffers()
+        self.response = []
+        self.headers_done = False
+        self.set_terminator(None)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((self.harness.host, self.harness.port))
+
+    def handle_connect(self):
+        path = self.stream and "/feed/status/stream/" or "/feed/status/"
+        if self.since is not None:
+            path += "?since=%d" % self.since
+        cookie = ""
+        if self.harness.session:
+            cookie = "Cookie: %s=%s\r\n" % (settings.SESSION_COOKIE_NAME, self.harness.session)
+        self.push("GET %s HTTP/1.0\r\nHost: %s\r\n%s\r\n" % (path, self.harness.host, cookie))
+
+    def collect_incoming_data(self, data):
+        self.response.append(data)
+        if self.stream:
+            self.read_events()
+
+    def read_events(self):
+        """Pull complete events out of what the stream has sent so far"""
+        text = "".join(self.response)
+        if not self.headers_done:
+            if "\r\n\r\n" not in text:
+                return
+            head, text = text.split("\r\n\r\n", 1)
+            if not head.startswith("HTTP/1.0 200"):
+                self.errors += 1
+            self.headers_done = True
+        while "\n\n" in text:
+            event, text = text.split("\n\n", 1)
+            for line in event.split("\n"):
+                if line.startswith("id: "):
+                    self.since = int(line[4:])
+                elif line.startswith("data: "):
+                    self.deliver(simplejson.loads(line[6:]))
+        self.response = [text]
+
+    def handle_close(self):
+        self.close()
+        if not self.stream:
+            text = "".join(self.response)
+            try:
+                head, body = text.split("\r\n\r\n", 1)
+                result = simplejson.loads(body)
+            except ValueError:
+                self.errors += 1
+            else:
+                if result.get('reset'):
+                    self.errors += 1
+                self.since = result['last']
+                for delta in result.get('events', []):
+                    self.deliver(delta)
+        if self.harness.running:
+            self.connect_to_feed()
+
+    def handle_error(self):
+        self.errors += 1
+        self.close()
+        if self.harness.running:
+            self.connect_to_feed()
+
+    def is_ready(self):
+        """Has the server answered this client yet, so that no later delta can be missed?"""
+        if self.stream:
+            return self.headers_done
+        return self.since is not None
+
+    def deliver(self, delta):
+        self.received += 1
+        if delta['type'] == "scan":
+            self.harness.arrived(delta.get('change_id'))
+
+
+class Harness(object):
+    def __init__(self, host, port, session):
+        self.host, self.port, self.session = host, port, session
+        self.running = True
+        self.injected = {}      # StatusChange id: time journaled
+        self.latencies = []
+
+    def inject(self):
+        change = StatusChange.record(StatusChange.SCAN, section="")
+        self.injected[change.id] = time.time()
+
+    def arrived(self, change_id):
+        if change_id in self.injected:
+            self.latencies.append(time.time() - self.injected[change_id])
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [--clients N] [--inject N] [--stream]")
+    parser.add_option("-H", "--host", default="localhost",
+        help="Feed server host (default localhost)")
+    parser.add_option("-p", "--port", type="int", default=8081,
+        help="Feed server port (default 8081)")
+    parser.add_option("-c", "--clients", type="int", default=100,
+        help="Number of simulated dashboards (default 100)")
+    parser.add_option("-s", "--stream", action="store_true",
+        help="Read event streams instead of long-polling")
+    parser.add_option("-i", "--inject", type="int", default=10,
+        help="Number of synthetic scans to journal (default 10)")
+    parser.add_option("-t", "--interval", type="float", default=1.0,
+        help="Seconds between synthetic scans (default 1)")
+    parser.add_option("-w", "--wait", type="float", default=5.0,
+        help="Seconds to keep listening after the last scan (default 5)")
+    parser.add_option("-k", "--session",
+        help="Session key of a logged-in user, if the server checks sessions")
+    (options, args) = parser.parse_args()
+
+    harness = Harness(options.host, options.port, options.session)
+    clients = [SimulatedClient(harness, options.stream) for n in range(options.clients)]
+    # Start journaling once every client is connected (or after half a minute)
+    give_up = time.time() + 30
+    while time.time() < give_up and not all([c.is_ready() for c in clients]):
+        asyncore.loop(timeout=0.1, use_poll=True, count=1)
+    next_inject = time.time() + options.interval
+    stop = next_inject + options.inject * options.interval + options.wait
+    while time.time() < stop:
+        asyncore.loop(timeout=0.1, use_poll=True, count=1)
+        if len(harness.injected) < options.inject and time.time() >= next_inject:
+            harness.inject()
+            next_inject += options.interval
+    harness.running = False
+    for client in clients:
+        client.close()
+
+    expected = len(harness.injected) * len(clients)
+    print "%d clients (%d connected), %d scans journaled" % (len(clients), 
+        len([c for c in clients if c.is_ready()]), len(harness.injected))
+    print "Deltas per client: min %d, max %d" % (min([c.received for c in clients]),
+        max([c.received for c in clients]))
+    print "Scan deliveries: %d of %d" % (len(harness.latencies), expected)
+    if harness.latencies:
+        print "Latency: mean %.2fs, max %.2fs" % (sum(harness.latencies) / len(harness.latencies),
+            max(harness.latencies))
+    print "Errors: %d" % sum([c.errors for c in clients])
+    StatusChange.objects.filter(id__in=harness.injected.keys()).delete()